@@ -5,35 +5,105 @@ Enhanced query processing and retrieval with better result presentation
 """
 
 import os
+import copy
 import json
-import re
-from typing import List, Dict, Tuple, Optional
+import atexit
+import functools
+import time
+import hashlib
+from typing import List, Dict, Tuple, Optional, Union
 import logging
-from datetime import datetime
 from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
+from chunk_store import load_chunk_table
+from embedding_cache import QueryEmbeddingCache, DEFAULT_QUERY_CACHE_SIZE
+from encode_batcher import EncodeBatcher, DEFAULT_BATCH_WINDOW_MS, DEFAULT_MAX_BATCH_SIZE
+from lexical_index import BM25Index
+from term_matcher import TermMatcher, load_vocabulary
+from highlighter import QueryHighlighter
+from vector_index import (read_index_mmap, is_inner_product, migrate_to_inner_product, normalize, relevance_from_similarity,
+                          set_search_params, search_rows, describe_index, load_sharded_index, ShardedIndex,
+                          reconstruct_rows, load_neighbor_table, DEFAULT_EF_SEARCH, DEFAULT_NPROBE)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Results below this cosine similarity are dropped instead of padding out top_k
+MIN_RELEVANCE_SCORE = 0.2
+
+# Hybrid retrieval: candidates taken from each stage and their weights in reciprocal-rank fusion
+HYBRID_LEXICAL_TOP_K = 20
+HYBRID_SEMANTIC_TOP_K = 20
+HYBRID_LEXICAL_WEIGHT = 1.0
+HYBRID_SEMANTIC_WEIGHT = 1.0
+
+# Rank offset of reciprocal-rank fusion; damps the advantage of the very first ranks
+RRF_K = 60
+
+# Queries encoded per forward pass by search_many
+QUERY_BATCH_SIZE = 128
+
+# Query expansion: synonym variants searched next to each query, and the weight
+# of their similarities in the max-merge, so the original wording wins ties
+MAX_QUERY_VARIANTS = 4
+VARIANT_WEIGHT = 0.95
+
 class AdvancedESCSearch:
     """
     Advanced search system for ESC Guidelines with enhanced query processing
     """
     
-    def __init__(self, processed_dir: str = "processed_guidelines"):
+    def __init__(self, processed_dir: str = "processed_guidelines",
+                 ef_search: Optional[int] = None, nprobe: Optional[int] = None,
+                 hybrid: Optional[bool] = None,
+                 lexical_top_k: Optional[int] = None, semantic_top_k: Optional[int] = None,
+                 lexical_weight: Optional[float] = None, semantic_weight: Optional[float] = None,
+                 query_cache_size: Optional[int] = None, query_cache_file: Optional[str] = None,
+                 batch_window_ms: Optional[float] = None, max_batch_size: Optional[int] = None,
+                 vocabulary_file: Optional[str] = None):
         self.processed_dir = processed_dir
         self.chunks_file = os.path.join(processed_dir, "chunks.json")
+        self.chunk_store_file = os.path.join(processed_dir, "chunks.bin")
         self.index_file = os.path.join(processed_dir, "faiss_index.bin")
+        self.lexical_index_file = os.path.join(processed_dir, "bm25_index.npz")
         self.metadata_file = os.path.join(processed_dir, "metadata.json")
+        self.version_file = os.path.join(processed_dir, "version.json")
+        self.vectors_file = os.path.join(processed_dir, "embeddings.npy")
+        self.neighbors_file = os.path.join(processed_dir, "neighbors.npz")
         
         # Initialize model as None - will be loaded lazily
         self.embedding_model = None
         self.model_load_attempted = False
         self.model_load_error = None
         
+        # Concurrent query encodes are batched into shared forward passes once the model is loaded
+        self.encoder = None
+        self.batch_window_ms = (batch_window_ms if batch_window_ms is not None
+                                else float(os.environ.get('ENCODE_BATCH_WINDOW_MS', DEFAULT_BATCH_WINDOW_MS)))
+        self.max_batch_size = max_batch_size or int(os.environ.get('ENCODE_BATCH_SIZE', DEFAULT_MAX_BATCH_SIZE))
+        
+        # Query-time index knobs (HNSW efSearch, IVF nprobe)
+        self.ef_search = ef_search or int(os.environ.get('FAISS_EF_SEARCH', DEFAULT_EF_SEARCH))
+        self.nprobe = nprobe or int(os.environ.get('FAISS_NPROBE', DEFAULT_NPROBE))
+        
+        # Hybrid retrieval: BM25 and FAISS rankings fused by weighted reciprocal rank
+        self.hybrid = hybrid if hybrid is not None else os.environ.get('HYBRID_SEARCH', '1') == '1'
+        self.lexical_top_k = lexical_top_k or int(os.environ.get('HYBRID_LEXICAL_TOP_K', HYBRID_LEXICAL_TOP_K))
+        self.semantic_top_k = semantic_top_k or int(os.environ.get('HYBRID_SEMANTIC_TOP_K', HYBRID_SEMANTIC_TOP_K))
+        self.lexical_weight = (lexical_weight if lexical_weight is not None
+                               else float(os.environ.get('HYBRID_LEXICAL_WEIGHT', HYBRID_LEXICAL_WEIGHT)))
+        self.semantic_weight = (semantic_weight if semantic_weight is not None
+                                else float(os.environ.get('HYBRID_SEMANTIC_WEIGHT', HYBRID_SEMANTIC_WEIGHT)))
+        
+        # LRU cache of query vectors (0 disables it), optionally persisted across restarts
+        if query_cache_size is None:
+            query_cache_size = int(os.environ.get('QUERY_CACHE_SIZE', DEFAULT_QUERY_CACHE_SIZE))
+        self.query_cache = QueryEmbeddingCache(query_cache_size,
+                                               query_cache_file or os.environ.get('QUERY_CACHE_FILE') or None)
+        if self.query_cache.path:
+            atexit.register(self.query_cache.save)
+        
         # Load processed data
         try:
             self.load_data()
@@ -55,24 +125,110 @@ class AdvancedESCSearch:
             'stent': ['percutaneous coronary intervention', 'PCI'],
             'bypass': ['CABG', 'coronary artery bypass graft']
         }
+        
+        # Whole-word matcher over every term and synonym, plus an optional larger vocabulary file
+        self.term_matcher = TermMatcher(self.medical_synonyms)
+        vocabulary_file = vocabulary_file or os.environ.get('MEDICAL_VOCABULARY_FILE')
+        if vocabulary_file:
+            for term, synonyms in load_vocabulary(vocabulary_file).items():
+                self.term_matcher.add(term, synonyms)
     
     def load_data(self):
         """Load processed chunks, metadata, and FAISS index"""
         logger.info("Loading processed data...")
         
-        # Load chunks
-        with open(self.chunks_file, 'r', encoding='utf-8') as f:
-            self.chunks = json.load(f)
+        # Version of the data on disk, used to tag cached results. Read first: if a
+        # new build lands while loading, the newer version marker triggers another reload.
+        self.index_version = self._data_version()
+        
+        # Load chunks as a columnar table: memory-mapped from chunks.bin, or built from chunks.json for older builds
+        self.chunks = load_chunk_table(self.chunk_store_file, self.chunks_file)
         
         # Load metadata
         with open(self.metadata_file, 'r', encoding='utf-8') as f:
             self.metadata = json.load(f)
         
-        # Load FAISS index
-        self.index = faiss.read_index(self.index_file)
+        # Load the per-guideline FAISS shards (or the single index of older builds)
+        # with their vectors memory-mapped, shared between workers
+        self.index = load_sharded_index(self.processed_dir, self.metadata)
+        if self.index is None:
+            self.index = read_index_mmap(self.index_file)
+        
+        # Older builds wrote an L2 index over raw vectors; convert it so scores are cosine similarities
+        if not is_inner_product(self.index):
+            logger.warning("FAISS index uses L2 distance, converting in memory. "
+                           "Re-run esc_guidelines_processor.py to migrate it on disk.")
+            self.index = migrate_to_inner_product(self.index)
+        
+        self.set_search_params(self.ef_search, self.nprobe)
+        
+        # Load the BM25 index, or build it in memory for data processed before it existed
+        if os.path.exists(self.lexical_index_file):
+            self.lexical_index = BM25Index.load(self.lexical_index_file)
+        else:
+            logger.warning("No BM25 index found, building it in memory. "
+                           "Re-run esc_guidelines_processor.py to save it.")
+            self.lexical_index = BM25Index.build([self.chunks.text(i) for i in range(len(self.chunks))])
+        
+        # Exact chunk vectors (memory-mapped) and precomputed similar chunks, when the build has them
+        self.vectors = None
+        if os.path.exists(self.vectors_file):
+            vectors = np.load(self.vectors_file, mmap_mode='r')
+            if len(vectors) == len(self.chunks):
+                self.vectors = vectors
+        
+        self.neighbors = None
+        if os.path.exists(self.neighbors_file):
+            scores, rows = load_neighbor_table(self.neighbors_file)
+            if len(rows) == len(self.chunks):
+                self.neighbors = (scores, rows)
         
         logger.info(f"Loaded {len(self.chunks)} chunks and index with {self.index.ntotal} vectors")
     
+    def reload(self) -> 'AdvancedESCSearch':
+        """
+        Load the processed data again into a new instance that shares this
+        one's settings, embedding model and query cache. This instance is
+        left untouched, so it keeps serving until the caller swaps references.
+        """
+        reloaded = copy.copy(self)
+        reloaded.load_data()
+        return reloaded
+    
+    def _data_version(self) -> str:
+        """
+        Build id published by the processor in version.json, or for older
+        builds a short fingerprint of the processed files (size and
+        modification time); identical in every process that loads the same build
+        """
+        if os.path.exists(self.version_file):
+            try:
+                with open(self.version_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)['version']
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not read {self.version_file}: {e}")
+        
+        digest = hashlib.blake2b(digest_size=8)
+        for path in (self.chunk_store_file, self.chunks_file, self.index_file,
+                     self.lexical_index_file, self.metadata_file):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return digest.hexdigest()
+    
+    def set_search_params(self, ef_search: Optional[int] = None, nprobe: Optional[int] = None):
+        """
+        Tune the recall/latency trade-off at runtime: efSearch for HNSW
+        indexes, nprobe for IVF indexes. Unset values are left unchanged.
+        """
+        if ef_search:
+            self.ef_search = ef_search
+        if nprobe:
+            self.nprobe = nprobe
+        
+        set_search_params(self.index, ef_search=ef_search, nprobe=nprobe)
+        logger.info(f"Index search parameters: {describe_index(self.index)}")
+    
     def _load_embedding_model(self):
         """Lazy loading of embedding model with error handling"""
         if self.model_load_attempted:
@@ -83,6 +239,9 @@ class AdvancedESCSearch:
             logger.info("🤖 Loading embedding model (this may take a moment)...")
             from sentence_transformers import SentenceTransformer
             self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            # Bound to the model, not this instance, so reloaded copies can share it
+            self.encoder = EncodeBatcher(functools.partial(self.embedding_model.encode, batch_size=QUERY_BATCH_SIZE),
+                                         self.batch_window_ms, self.max_batch_size)
             logger.info("✅ Embedding model loaded successfully")
             return True
         except Exception as e:
@@ -91,154 +250,327 @@ class AdvancedESCSearch:
             logger.warning("🔄 Search will use fallback text matching instead of semantic search")
             return False
     
-    def _fallback_search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Fallback text-based search when embedding model fails"""
-        logger.info("Using fallback text-based search")
-        
-        query_lower = query.lower()
-        scored_chunks = []
+    def warm_up(self, queries: List[str]) -> Dict:
+        """
+        Load the embedding model and run each query through the full search
+        path (encode, FAISS, BM25, fusion) plus one guideline-filtered search,
+        so lazy initialization and first-touch page faults happen before traffic
+        """
+        started = time.perf_counter()
+        model_loaded = self._load_embedding_model()
+        
+        # Warm-up vectors are not worth saving; with gunicorn --preload this keeps
+        # the master from writing its cache over the ones the workers saved
+        changed = self.query_cache.changed
+        for query in queries:
+            self.search(query)
+        if queries and self.chunks.documents:
+            self.search(queries[0], filter_guideline=self.chunks.documents[0])
+        self.query_cache.changed = changed
+        
+        # Build the chunk id map used by direct chunk lookups
+        if len(self.chunks):
+            self.get_chunk(self.chunks.chunk_id(0))
+        
+        seconds = time.perf_counter() - started
+        logger.info(f"🔥 Warm-up finished: {len(queries)} queries in {seconds:.2f}s")
+        return {'model_loaded': model_loaded, 'queries': len(queries), 'seconds': seconds}
+    
+    def _fallback_search(self, query: str, top_k: int = 5, allowed: Optional[np.ndarray] = None) -> List[Dict]:
+        """Fallback lexical search (BM25) when the embedding model fails, optionally limited to a row mask"""
+        logger.info("Using fallback BM25 text search")
+        
+        return [{
+            'chunk_index': i,
+            'score': score,
+            'chunk': self.chunks[i]
+        } for i, score in self.lexical_index.search(query, top_k, allowed)]
+    
+    def query_variants(self, query: str) -> List[str]:
+        """
+        The query followed by rewrites with one medical term replaced by a
+        synonym (e.g. "AF anticoagulation" -> "atrial fibrillation
+        anticoagulation"). Each is embedded and searched on its own, instead
+        of diluting one vector with every synonym.
+        """
+        variants = [query] + self.term_matcher.variants(query, MAX_QUERY_VARIANTS)
         
-        for i, chunk in enumerate(self.chunks):
-            text_lower = chunk['text'].lower()
-            
-            # Simple scoring based on term frequency and position
-            score = 0
-            query_terms = query_lower.split()
-            
-            for term in query_terms:
-                # Count occurrences
-                count = text_lower.count(term)
-                if count > 0:
-                    score += count * 10
-                    
-                    # Bonus for term appearing early in text
-                    first_pos = text_lower.find(term)
-                    if first_pos < 100:  # First 100 characters
-                        score += 5
-            
-            if score > 0:
-                scored_chunks.append({
-                    'chunk_index': i,
-                    'score': score,
-                    'chunk': chunk
-                })
+        if len(variants) > 1:
+            logger.info(f"Query '{query}' expanded to {len(variants) - 1} variants: {variants[1:]}")
         
-        # Sort by score and return top results
-        scored_chunks.sort(key=lambda x: x['score'], reverse=True)
-        return scored_chunks[:top_k]
+        return variants
     
     def expand_query(self, query: str) -> str:
         """
-        Expand query with medical synonyms and related terms
+        Single-string expansion kept for callers of the old API: the query
+        followed by the new words of its variants. Search uses query_variants().
         """
-        expanded_terms = [query]
-        query_lower = query.lower()
-        
-        # Add synonyms
-        for term, synonyms in self.medical_synonyms.items():
-            if term in query_lower:
-                expanded_terms.extend(synonyms)
-            for synonym in synonyms:
-                if synonym in query_lower:
-                    expanded_terms.append(term)
-                    expanded_terms.extend([s for s in synonyms if s != synonym])
-                    break
-        
-        # Create expanded query
-        expanded_query = ' '.join(set(expanded_terms))
-        
-        if expanded_query != query:
-            logger.info(f"Query expanded from: '{query}' to: '{expanded_query}'")
-        
-        return expanded_query
+        return ' '.join(dict.fromkeys(word for variant in self.query_variants(query) for word in variant.split()))
     
     def search(self, query: str, top_k: int = 10, expand_query: bool = True, 
-               filter_guideline: Optional[str] = None) -> List[Dict]:
+               filter_guideline: Optional[str] = None,
+               min_score: float = MIN_RELEVANCE_SCORE,
+               hybrid: Optional[bool] = None) -> List[Dict]:
+        """
+        Enhanced search with query expansion and filtering.
+        Semantic hits with a cosine similarity below min_score are dropped.
+        In hybrid mode (default from the constructor) BM25 hits on the
+        unexpanded query are fused with the semantic ranking, so exact terms
+        and abbreviations are found even when their embedding is not close.
         """
-        Enhanced search with query expansion and filtering
+        return self.search_many([query], top_k=top_k, expand_query=expand_query,
+                                filter_guideline=filter_guideline, min_score=min_score, hybrid=hybrid)[0]
+    
+    def search_many(self, queries: List[Union[str, Dict]], top_k: int = 10, expand_query: bool = True,
+                    filter_guideline: Optional[str] = None,
+                    min_score: float = MIN_RELEVANCE_SCORE,
+                    hybrid: Optional[bool] = None) -> List[List[Dict]]:
+        """
+        Search many queries at once: one batched encode for all queries (and
+        expansion variants) that are not cached and one FAISS search over the
+        whole query matrix; each query's variants are max-merged.
+        Each query is a string or a dict with 'query' and optional 'top_k',
+        'expand_query' and 'filter_guideline' overriding the defaults.
+        Returns one result list per query, in input order.
         """
+        if hybrid is None:
+            hybrid = self.hybrid
+        
+        requests = []
+        for item in queries:
+            if isinstance(item, str):
+                item = {'query': item}
+            requests.append({
+                'query': item['query'],
+                'top_k': int(item.get('top_k', top_k)),
+                'expand_query': item.get('expand_query', expand_query),
+                'filter_guideline': item.get('filter_guideline', filter_guideline)
+            })
+        
+        if not requests:
+            return []
+        
         # Try to load embedding model if not already loaded
         if not self._load_embedding_model():
             # Use fallback search if model loading failed
             logger.info("Using fallback text-based search due to model loading failure")
-            fallback_results = self._fallback_search(query, top_k)
-            
-            results = []
-            for result in fallback_results:
-                chunk = result['chunk'].copy()
-                
-                # Apply guideline filter if specified
-                if filter_guideline and filter_guideline.lower() not in chunk['document_name'].lower():
-                    continue
-                
-                # Add search metadata
-                chunk['search_score'] = result['score'] / 100.0  # Normalize score
-                chunk['search_method'] = 'text_fallback'
-                chunk['model_error'] = self.model_load_error
-                
-                results.append(chunk)
-            
-            return results[:top_k]
+            return [self._fallback_results(r['query'], r['top_k'], r['filter_guideline']) for r in requests]
         
-        # Expand query if requested
-        if expand_query:
-            search_query = self.expand_query(query)
-        else:
-            search_query = query
+        # Expand queries if requested; the variants of all queries are encoded and searched together
+        rows = 0
+        for r in requests:
+            r['variants'] = self.query_variants(r['query']) if r['expand_query'] else [r['query']]
+            r['rows'] = list(range(rows, rows + len(r['variants'])))
+            rows += len(r['variants'])
         
-        # Generate query embedding
+        # Generate query embeddings
         try:
-            query_embedding = self.embedding_model.encode([search_query])
+            query_embeddings = self._encode_queries([variant for r in requests for variant in r['variants']])
         except Exception as e:
             logger.error(f"❌ Error generating query embedding: {e}")
             # Fall back to text search
-            return self._fallback_search(query, top_k)
+            return [self._fallback_results(r['query'], r['top_k'], r['filter_guideline']) for r in requests]
+        
+        # Candidate pool per stage and query
+        for r in requests:
+            r['semantic_k'] = max(r['top_k'], self.semantic_top_k) if hybrid else r['top_k']
+            r['lexical_k'] = max(r['top_k'], self.lexical_top_k)
+        
+        # Queries sharing a guideline filter are searched together; filtered
+        # searches only visit that guideline's rows, so nothing is over-fetched
+        groups = {}
+        for i, r in enumerate(requests):
+            groups.setdefault(r['filter_guideline'], []).append(i)
+        
+        all_results = [None] * len(requests)
+        for filter_guideline, positions in groups.items():
+            allowed = self._filter_mask(filter_guideline)
+            fetch_k = max(requests[i]['semantic_k'] for i in positions)
+            vectors = query_embeddings[[row for i in positions for row in requests[i]['rows']]]
+            
+            try:
+                if allowed is None:
+                    scores, indices = self.index.search(vectors, min(fetch_k, len(self.chunks)))
+                elif isinstance(self.index, ShardedIndex):
+                    # Only the matching guidelines' shards are searched
+                    scores, indices = self.index.search(vectors, fetch_k,
+                                                        shards=self._filter_documents(filter_guideline))
+                else:
+                    scores, indices = search_rows(self.index, vectors, fetch_k,
+                                                  np.flatnonzero(allowed), self.ef_search, self.nprobe)
+            except Exception as e:
+                logger.error(f"❌ Error searching FAISS index: {e}")
+                # Fall back to text search
+                for i in positions:
+                    all_results[i] = self._fallback_results(requests[i]['query'], requests[i]['top_k'], filter_guideline)
+                continue
+            
+            row = 0
+            for i in positions:
+                n = len(requests[i]['variants'])
+                k = requests[i]['semantic_k']
+                query_scores, query_indices = self._merge_variants(scores[row:row + n], indices[row:row + n], k)
+                all_results[i] = self._rank_results(requests[i], query_scores, query_indices,
+                                                    allowed, min_score, hybrid)
+                row += n
+        
+        return all_results
+    
+    def _merge_variants(self, scores: np.ndarray, indices: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Merge the neighbor lists of a query (first row) and its variants into
+        one list: each chunk keeps its best similarity, variants' scaled by
+        VARIANT_WEIGHT, sorted best first with ties broken by row
+        """
+        if len(scores) == 1:
+            return scores[0][:k], indices[0][:k]
         
-        # Search in FAISS index
-        try:
-            scores, indices = self.index.search(query_embedding.astype('float32'), min(top_k * 3, len(self.chunks)))
-        except Exception as e:
-            logger.error(f"❌ Error searching FAISS index: {e}")
-            # Fall back to text search
-            return self._fallback_search(query, top_k)
+        weights = np.full((len(scores), 1), VARIANT_WEIGHT, dtype=np.float32)
+        weights[0] = 1.0
+        
+        best = {}
+        for score, idx in zip((scores * weights).ravel(), indices.ravel()):
+            if idx >= 0 and score > best.get(idx, -np.inf):
+                best[idx] = score
+        
+        ranked = sorted(best.items(), key=lambda hit: (-hit[1], hit[0]))[:k]
+        return (np.array([score for _, score in ranked], dtype=np.float32),
+                np.array([idx for idx, _ in ranked], dtype=np.int64))
+    
+    def _rank_results(self, request: Dict, scores: np.ndarray, indices: np.ndarray,
+                      allowed: Optional[np.ndarray], min_score: float, hybrid: bool) -> List[Dict]:
+        """
+        Turn one query's FAISS neighbors (and BM25 hits in hybrid mode) into
+        ranked result dicts; `allowed` is the guideline filter's row mask
+        """
+        query = request['query']
+        top_k = request['top_k']
+        
+        semantic = []
+        for score, idx in zip(scores, indices):
+            # Scores are sorted, so everything after the first weak hit is weaker
+            if score < min_score:
+                break
+            
+            if 0 <= idx < len(self.chunks):
+                semantic.append((int(idx), float(score)))
+        
+        similarities = dict(semantic)
+        if hybrid:
+            lexical = self.lexical_index.search(query, request['lexical_k'], allowed)
+            lexical_scores = dict(lexical)
+            ranked = self._fuse_rankings(semantic, lexical)
+            best_fusion = (self.semantic_weight + self.lexical_weight) / (RRF_K + 1)
+        else:
+            ranked = semantic
+        
+        # One pattern for the query, applied only to the results returned
+        highlighter = QueryHighlighter(query)
         
         results = []
-        for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.chunks):
-                chunk = self.chunks[idx].copy()
-                
-                # Apply guideline filter if specified
-                if filter_guideline and filter_guideline.lower() not in chunk['document_name'].lower():
-                    continue
-                
-                # Calculate relevance score (lower FAISS distance = higher relevance)
-                chunk['similarity_score'] = float(score)
-                chunk['relevance_score'] = max(0, 1 - score)  # Convert to 0-1 scale
-                chunk['rank'] = len(results) + 1
-                
-                # Add query highlighting
-                chunk['highlighted_text'] = self.highlight_query_terms(chunk['text'], query)
-                
-                results.append(chunk)
-                
-                if len(results) >= top_k:
-                    break
+        for idx, score in ranked[:top_k]:
+            chunk = self.chunks[idx]
+            
+            if idx in similarities:
+                chunk['similarity_score'] = similarities[idx]
+            
+            if hybrid:
+                if idx in lexical_scores:
+                    chunk['lexical_score'] = lexical_scores[idx]
+                # Fused score relative to a hit ranked first by both stages
+                chunk['fusion_score'] = score
+                chunk['relevance_score'] = min(1.0, score / best_fusion) if best_fusion > 0 else 0.0
+                chunk['search_method'] = 'hybrid'
+            else:
+                # Cosine similarity of normalized vectors, clipped to a 0-1 relevance
+                chunk['relevance_score'] = relevance_from_similarity(score)
+            chunk['rank'] = len(results) + 1
+            
+            # Add query highlighting: match offsets in the text, and a marked snippet around the best matches
+            chunk['highlights'] = highlighter.offsets(chunk['text'])
+            chunk['highlighted_text'] = highlighter.highlighted_snippet(chunk['text'], spans=chunk['highlights'])
+            
+            results.append(chunk)
         
         return results
     
-    def highlight_query_terms(self, text: str, query: str) -> str:
+    def _fallback_results(self, query: str, top_k: int, filter_guideline: Optional[str] = None) -> List[Dict]:
         """
-        Highlight query terms in text
+        BM25 fallback results in the same shape as search() results
         """
-        query_terms = query.lower().split()
-        highlighted_text = text
+        results = []
+        for result in self._fallback_search(query, top_k, self._filter_mask(filter_guideline)):
+            chunk = result['chunk']
+            
+            # Add search metadata
+            chunk['search_score'] = result['score']  # BM25 score
+            chunk['search_method'] = 'text_fallback'
+            chunk['model_error'] = self.model_load_error
+            
+            results.append(chunk)
         
-        for term in query_terms:
-            if len(term) > 2:  # Only highlight terms longer than 2 characters
-                pattern = re.compile(re.escape(term), re.IGNORECASE)
-                highlighted_text = pattern.sub(f"**{term.upper()}**", highlighted_text)
+        return results[:top_k]
+    
+    def _encode_queries(self, queries: List[str]) -> np.ndarray:
+        """
+        Normalized embeddings of (possibly expanded) queries as an n x d
+        matrix. Queries seen before come from the LRU query cache; the rest
+        are encoded together in one batch, shared with concurrent requests.
+        """
+        vectors = [self.query_cache.get(query) for query in queries]
+        missing = list(dict.fromkeys(query for query, vector in zip(queries, vectors) if vector is None))
+        
+        if missing:
+            encoded = normalize(self.encoder.encode(missing))
+            encoded = dict(zip(missing, encoded))
+            for query, vector in encoded.items():
+                self.query_cache.put(query, vector)
+            vectors = [encoded[query] if vector is None else vector for query, vector in zip(queries, vectors)]
+        
+        return np.ascontiguousarray(np.stack(vectors), dtype=np.float32)
+    
+    def _filter_mask(self, filter_guideline: Optional[str]) -> Optional[np.ndarray]:
+        """
+        Boolean row mask of the chunks whose document name contains the
+        filter (case-insensitive), or None when no filter is set
+        """
+        if not filter_guideline:
+            return None
         
-        return highlighted_text
+        documents = set(self._filter_documents(filter_guideline))
+        document_ids = [i for i, name in enumerate(self.chunks.documents) if name in documents]
+        return np.isin(self.chunks.document_ids, document_ids)
+    
+    def _filter_documents(self, filter_guideline: str) -> List[str]:
+        """Names of the guidelines whose name contains the filter (case-insensitive)"""
+        return [name for name in self.chunks.documents if filter_guideline.lower() in name.lower()]
+    
+    def _fuse_rankings(self, semantic: List[Tuple[int, float]],
+                       lexical: List[Tuple[int, float]]) -> List[Tuple[int, float]]:
+        """
+        Weighted reciprocal-rank fusion of two best-first (row, score) rankings:
+        each row scores sum(weight / (RRF_K + rank)) over the rankings it appears in
+        """
+        fused = {}
+        for weight, ranking in ((self.semantic_weight, semantic), (self.lexical_weight, lexical)):
+            for rank, (idx, _) in enumerate(ranking, 1):
+                fused[idx] = fused.get(idx, 0.0) + weight / (RRF_K + rank)
+        
+        # Stable sort keeps the semantic order for ties
+        return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+    
+    def highlight_query_terms(self, text: str, query: str) -> str:
+        """
+        Highlight query terms in text, keeping their original case
+        """
+        return QueryHighlighter(query).highlight(text)
+    
+    def get_chunk(self, chunk_id: str) -> Optional[Dict]:
+        """
+        A chunk by id, or None; looked up in the chunk id map, not by scanning
+        """
+        row = self.chunks.find_row(chunk_id)
+        return None if row is None else self.chunks[row]
     
     def get_document_summary(self, document_name: str) -> Dict:
         """
@@ -248,10 +580,10 @@ class AdvancedESCSearch:
             meta = self.metadata[document_name]
             
             # Count chunks by section
-            doc_chunks = [c for c in self.chunks if c['document_name'] == document_name]
+            section_ids = self.chunks.section_ids[self.chunks.document_rows(document_name)]
             sections = {}
-            for chunk in doc_chunks:
-                section = chunk.get('section_title', 'General')
+            for section_id in section_ids:
+                section = self.chunks.sections[section_id]
                 sections[section] = sections.get(section, 0) + 1
             
             return {
@@ -272,39 +604,27 @@ class AdvancedESCSearch:
     
     def get_similar_chunks(self, chunk_id: str, top_k: int = 5) -> List[Dict]:
         """
-        Find chunks similar to a given chunk
+        Find chunks similar to a given chunk. Served from the precomputed
+        neighbor table when it holds enough neighbors; otherwise the chunk's
+        stored vector is searched in the index. Neither needs the embedding model.
         """
-        # Try to load embedding model if not already loaded
-        if not self._load_embedding_model():
-            logger.warning("Cannot find similar chunks without embedding model")
-            return []
-        
-        # Find the chunk
-        target_chunk = None
-        target_idx = None
-        
-        for i, chunk in enumerate(self.chunks):
-            if chunk['chunk_id'] == chunk_id:
-                target_chunk = chunk
-                target_idx = i
-                break
-        
-        if not target_chunk:
+        target_idx = self.chunks.find_row(chunk_id)
+        if target_idx is None:
             return []
         
         try:
-            # Get embedding for this chunk
-            chunk_embedding = self.embedding_model.encode([target_chunk['text']])
-            
-            # Search for similar chunks
-            scores, indices = self.index.search(chunk_embedding.astype('float32'), top_k + 1)
+            if self.neighbors is not None and top_k <= self.neighbors[1].shape[1]:
+                neighbors = zip(self.neighbors[0][target_idx][:top_k], self.neighbors[1][target_idx][:top_k])
+            else:
+                scores, indices = self.index.search(self._chunk_vectors([target_idx]), top_k + 1)
+                neighbors = zip(scores[0], indices[0])
             
             results = []
-            for score, idx in zip(scores[0], indices[0]):
-                if idx != target_idx and idx < len(self.chunks):  # Exclude the original chunk
-                    chunk = self.chunks[idx].copy()
+            for score, idx in neighbors:
+                if idx != target_idx and 0 <= idx < len(self.chunks):  # Exclude the original chunk
+                    chunk = self.chunks[idx]
                     chunk['similarity_score'] = float(score)
-                    chunk['relevance_score'] = max(0, 1 - score)
+                    chunk['relevance_score'] = relevance_from_similarity(score)
                     results.append(chunk)
             
             return results[:top_k]
@@ -313,6 +633,15 @@ class AdvancedESCSearch:
             logger.error(f"❌ Error finding similar chunks: {e}")
             return []
     
+    def _chunk_vectors(self, rows: List[int]) -> np.ndarray:
+        """
+        Normalized vectors of chunk rows: exact from the embeddings.npy
+        sidecar, or reconstructed from the index for builds without it
+        """
+        if self.vectors is not None:
+            return normalize(self.vectors[rows])
+        return normalize(reconstruct_rows(self.index, rows))
+    
     def format_search_results(self, results: List[Dict], query: str) -> str:
         """
         Format search results for display
@@ -369,23 +698,10 @@ class AdvancedESCSearch:
     
     def extract_medical_terms(self, text: str) -> List[str]:
         """
-        Extract potential medical terms from text
+        Extract potential medical terms from text: the preferred term of each
+        vocabulary concept mentioned by name or synonym, in order of mention
         """
-        medical_terms = []
-        text_lower = text.lower()
-        
-        # Check for known medical terms
-        for term in self.medical_synonyms.keys():
-            if term in text_lower:
-                medical_terms.append(term)
-        
-        # Check for synonyms
-        for term, synonyms in self.medical_synonyms.items():
-            for synonym in synonyms:
-                if synonym in text_lower and term not in medical_terms:
-                    medical_terms.append(term)
-        
-        return medical_terms
+        return self.term_matcher.concepts_in(text)
 
 def main():
     """
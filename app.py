@@ -6,10 +6,16 @@ ESC Guidelines AI Search Tool - Render Deployment Version
 import os
 import sys
 import json
+import hmac
+import hashlib
+import time
 import logging
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string
 from flask_cors import CORS
+from result_cache import result_cache_from_env
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -21,6 +27,33 @@ CORS(app)
 # Get port from environment (Render sets this)
 PORT = int(os.environ.get('PORT', 5000))
 
+# Seconds between checks of processed_guidelines/version.json for a new build (0 disables the watcher)
+RELOAD_POLL_SECONDS = float(os.environ.get('RELOAD_POLL_SECONDS', 30))
+
+# Token required by /admin endpoints (they are disabled when unset)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+# Limits for /search/batch: queries per request, and queries searched together when streaming
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', 1000))
+BATCH_STREAM_SIZE = 64
+
+# Result shapes of /search and /search/batch: full chunks, or ranked snippets with chunk ids
+SEARCH_MODES = ('full', 'snippet')
+SNIPPET_RESULT_FIELDS = ('chunk_id', 'rank', 'relevance_score', 'document_name', 'page_number', 'section_title')
+
+# Seconds clients may reuse a /chunks response before revalidating it with its ETag
+CHUNK_MAX_AGE = 3600
+
+# Warm-up searches run by create_app() before the server accepts traffic (WARMUP=0 only loads the model)
+WARMUP = os.environ.get('WARMUP', '1') == '1'
+WARMUP_QUERIES = (
+    'hypertension management in diabetes',
+    'atrial fibrillation anticoagulation',
+    'acute coronary syndrome diagnosis',
+    'heart failure beta blockers',
+    'endocarditis prophylaxis'
+)
+
 # HTML template for the search interface
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -167,8 +200,8 @@ HTML_TEMPLATE = """
             
             results.forEach((result, index) => {
                 const relevanceScore = (result.relevance_score || (1 - result.similarity_score) || 0).toFixed(3);
-                const text = result.highlighted_text || result.text || '';
-                const displayText = text.length > 400 ? text.substring(0, 400) + '...' : text;
+                const text = result.text || '';
+                const displayText = result.snippet || result.highlighted_text || (text.length > 400 ? text.substring(0, 400) + '...' : text);
                 
                 html += `
                     <div class="result-item">
@@ -197,7 +230,7 @@ HTML_TEMPLATE = """
                 const endpoint = searchType === 'clinical' ? '/clinical-search' : '/search';
                 const body = searchType === 'clinical' 
                     ? { question: query, top_k: topK }
-                    : { query: query, top_k: topK };
+                    : { query: query, top_k: topK, mode: 'snippet' };
                 
                 const response = await fetch(endpoint, {
                     method: 'POST',
@@ -258,12 +291,292 @@ HTML_TEMPLATE = """
 </html>
 """
 
-# Initialize search system (will be None if data not available)
+# Initialize search system (will be None if data not available).
+# Handlers read this global once per request, so a reload that assigns a new
+# instance never changes the data under a request that is already running.
 search_system = None
 
-def initialize_search_system():
-    """Initialize the search system if data is available"""
+# Hot reload state: one reload at a time, status reported by /admin/reload
+reload_lock = threading.Lock()
+reload_state = {'status': 'idle', 'version': None, 'reloaded_at': None, 'error': None}
+reload_watcher = None
+reload_watcher_pid = None
+watcher_lock = threading.Lock()
+
+# Outcome of the last warm-up, reported by /health
+warmup_state = {'status': 'pending', 'queries': 0, 'seconds': None, 'model_loaded': False, 'error': None}
+
+# Cache of serialized /search and /clinical-search responses (None when disabled)
+result_cache = result_cache_from_env()
+
+def cached_payload(system, endpoint, params, compute):
+    """
+    Serialized JSON for a response, from the result cache or computed,
+    serialized and cached. Keys include the index version of the search
+    system that answers, so a rebuilt index never serves stale results.
+    Returns the payload and the cache status ('HIT', 'MISS', or None when
+    caching is disabled).
+    """
+    if result_cache is None:
+        return app.json.dumps(compute()).encode('utf-8'), None
+    
+    key = result_cache.make_key(system.index_version, endpoint, **params)
+    payload = result_cache.get(key)
+    status = 'HIT'
+    
+    if payload is None:
+        payload = app.json.dumps(compute()).encode('utf-8')
+        result_cache.set(key, payload)
+        status = 'MISS'
+    
+    return payload, status
+
+def cached_json_response(system, endpoint, params, compute):
+    """Flask response for cached_payload(), with an X-Cache header when caching is enabled"""
+    payload, status = cached_payload(system, endpoint, params, compute)
+    response = app.response_class(payload, mimetype='application/json')
+    if status:
+        response.headers['X-Cache'] = status
+    return response
+
+def format_results(results, mode):
+    """
+    Search results as returned by the search system ('full'), or only the
+    ranked snippets, chunk ids and citation fields ('snippet'); full text is
+    then fetched per chunk from /chunks/<chunk_id>
+    """
+    if mode != 'snippet':
+        return results
+    
+    return [dict({field: result[field] for field in SNIPPET_RESULT_FIELDS if field in result},
+                 snippet=result.get('highlighted_text', '')) for result in results]
+
+def search_params_error(top_k, filter_guideline=None, expand_query=True):
+    """
+    Error message for a top_k, filter_guideline or expand_query the search
+    system cannot take, or None. Checked before answering so a streamed response never
+    fails after its status line has been sent.
+    """
+    if isinstance(top_k, bool) or not isinstance(top_k, int) or top_k < 1:
+        return 'top_k must be a positive integer'
+    if filter_guideline is not None and not isinstance(filter_guideline, str):
+        return 'filter_guideline must be a string'
+    if not isinstance(expand_query, bool):
+        return 'expand_query must be true or false'
+    return None
+
+def search_response(system, query, top_k, expand_query, filter_guideline, mode='full'):
+    """Body of a /search response"""
+    results = system.search(query, top_k=top_k, expand_query=expand_query,
+                            filter_guideline=filter_guideline)
+    return {
+        'query': query,
+        'total_results': len(results),
+        'results': format_results(results, mode)
+    }
+
+def chunk_etag(system, chunk_id):
+    """ETag of a /chunks response; chunk texts only change with the index version"""
+    return hashlib.blake2b(f"{system.index_version}:{chunk_id}".encode('utf-8'), digest_size=12).hexdigest()
+
+def documents_response(system):
+    """Body of a /documents response"""
+    documents = []
+    for doc_name in system.metadata.keys():
+        summary = system.get_document_summary(doc_name)
+        documents.append(summary)
+    
+    return {
+        'total_documents': len(documents),
+        'documents': documents
+    }
+
+def health_response(system):
+    """Body of a /health response"""
+    if system:
+        return {
+            'status': 'healthy',
+            'live': True,
+            'ready': is_ready(system),
+            'warmup': warmup_state,
+            'total_chunks': len(system.chunks),
+            'total_documents': len(system.metadata),
+            'index_version': system.index_version,
+            'index_size': system.index.ntotal if system.index else 0,
+            'query_cache': system.query_cache.stats(),
+            'encoder': system.encoder.stats() if system.encoder else None,
+            'result_cache': result_cache.stats() if result_cache else None
+        }
+    
+    return {
+        'status': 'setup_required',
+        'live': True,
+        'ready': False,
+        'message': 'Search system not initialized. Data processing required.'
+    }
+
+def readiness_response(system):
+    """Body and status code of a /health/ready response"""
+    ready = is_ready(system)
+    return {
+        'ready': ready,
+        'index_version': system.index_version if system else None,
+        'warmup': warmup_state
+    }, 200 if ready else 503
+
+def load_and_publish_search_system():
+    """
+    Load processed_guidelines/ into a new search system (or a reload of the
+    serving one), warm it up and only then publish it with a single
+    assignment, so no request ever sees a half-initialized instance. Requests
+    in flight finish on the old snapshot; on failure the old one keeps
+    serving. The caller must hold reload_lock. Returns True on success.
+    """
     global search_system
+    reload_state.update(status='loading', error=None)
+    current = search_system
+    
+    try:
+        if current is None:
+            system = build_search_system()
+            if system is None:
+                raise RuntimeError("Search system could not be initialized")
+        else:
+            logger.info("🔄 Reloading processed data in the background...")
+            system = current.reload()
+        
+        warm_up_search_system(system)
+        search_system = system
+        
+        reload_state.update(status='idle', version=system.index_version,
+                            reloaded_at=datetime.now().isoformat())
+        logger.info(f"✅ Search system now serving data version {system.index_version}")
+        return True
+    except Exception as e:
+        reload_state.update(status='failed', error=str(e))
+        logger.error(f"❌ Reload failed, still serving the previous data: {e}")
+        return False
+
+def reload_search_system():
+    """
+    Reload the search system in the calling (background) thread.
+    Returns False if another reload is already running.
+    """
+    if not reload_lock.acquire(blocking=False):
+        return False
+    
+    try:
+        load_and_publish_search_system()
+    finally:
+        reload_lock.release()
+    
+    return True
+
+def read_version_marker(processed_dir='processed_guidelines'):
+    """Build id from version.json, written last by the processor, or None"""
+    try:
+        with open(os.path.join(processed_dir, 'version.json'), 'r', encoding='utf-8') as f:
+            return json.load(f).get('version')
+    except (OSError, ValueError):
+        return None
+
+def watch_version_marker():
+    """Reload whenever the processor publishes a build id different from the one being served"""
+    attempted = None
+    while True:
+        time.sleep(RELOAD_POLL_SECONDS)
+        version = read_version_marker()
+        system = search_system
+        
+        if version and version != attempted and (system is None or version != system.index_version):
+            logger.info(f"📦 New processed data version {version} found")
+            attempted = version
+            reload_search_system()
+
+def start_reload_watcher():
+    """
+    Start the version marker watcher thread once per process. Threads do not
+    survive fork, so with gunicorn --preload each worker starts its own
+    (from the first request) instead of inheriting the master's.
+    """
+    global reload_watcher, reload_watcher_pid
+    if RELOAD_POLL_SECONDS <= 0 or reload_watcher_pid == os.getpid():
+        return
+    
+    with watcher_lock:
+        if reload_watcher_pid == os.getpid():
+            return
+        reload_watcher = threading.Thread(target=watch_version_marker, name='reload-watcher', daemon=True)
+        reload_watcher.start()
+        reload_watcher_pid = os.getpid()
+
+def warm_up_search_system(system):
+    """
+    Load the embedding model and run the warm-up queries on a search system
+    that is not serving yet, recording the outcome in warmup_state
+    """
+    warmup_state.update(status='running', error=None)
+    try:
+        result = system.warm_up(list(WARMUP_QUERIES) if WARMUP else [])
+        warmup_state.update(status='done', **result)
+    except Exception as e:
+        warmup_state.update(status='failed', error=str(e))
+        logger.error(f"❌ Warm-up failed: {e}")
+
+def is_ready(system):
+    """Data loaded and embedding model loaded (or given up on, serving BM25 fallback results)"""
+    return system is not None and system.model_load_attempted
+
+def create_app():
+    """
+    Application factory for gunicorn: `gunicorn --preload "app:create_app()"`.
+    Loads the processed data and the embedding model and runs warm-up searches
+    before the server binds its port; with --preload this happens once in the
+    master, and forked workers share the loaded pages copy-on-write.
+    """
+    # The tokenizer's thread pool cannot be used after fork; workers tokenize single queries anyway
+    os.environ.setdefault('TOKENIZERS_PARALLELISM', 'false')
+    
+    # Neither can an OpenMP thread pool, so warm up without starting one
+    with single_threaded():
+        initialize_search_system()
+    return app
+
+@contextmanager
+def single_threaded():
+    """
+    Run torch and FAISS on one OpenMP thread inside the block, restoring the
+    thread counts afterwards. GNU libgomp starts its thread pool on the first
+    multi-threaded region and the pool does not survive fork: a --preload
+    master that encoded or searched several rows on it leaves every worker
+    hanging on its first multi-threaded encode or search. Restoring the counts
+    starts no pool, so workers start their own on first use.
+    """
+    import faiss
+    import torch
+    
+    faiss_threads = faiss.omp_get_max_threads()
+    torch_threads = torch.get_num_threads()
+    faiss.omp_set_num_threads(1)
+    torch.set_num_threads(1)
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(faiss_threads)
+        torch.set_num_threads(torch_threads)
+
+def initialize_search_system():
+    """
+    Load, warm up and publish the search system if none is serving yet,
+    waiting for a reload that is already running. Returns True once one is serving.
+    """
+    with reload_lock:
+        if search_system is None:
+            load_and_publish_search_system()
+    return search_system is not None
+
+def build_search_system():
+    """A new search system over processed_guidelines/, or None if data is missing or fails to load"""
     try:
         logger.info("🔄 Starting search system initialization...")
         
@@ -283,10 +596,10 @@ def initialize_search_system():
             logger.info(f"📄 Files in {processed_dir}: {processed_files}")
         else:
             logger.error(f"❌ {processed_dir} directory not found")
-            return False
+            return None
         
         # Check specific required files
-        required_files = ['chunks.json', 'metadata.json', 'faiss_index.bin']
+        required_files = ['chunks.json', 'metadata.json']
         missing_files = []
         
         for file in required_files:
@@ -298,30 +611,43 @@ def initialize_search_system():
                 missing_files.append(file)
                 logger.error(f"❌ Missing {file}")
         
+        # FAISS index: per-guideline shards, or a single file from older builds
+        if os.path.isdir(os.path.join(processed_dir, 'shards')):
+            logger.info(f"✅ Found shards: {len(os.listdir(os.path.join(processed_dir, 'shards')))} files")
+        elif os.path.exists(os.path.join(processed_dir, 'faiss_index.bin')):
+            logger.info(f"✅ Found faiss_index.bin: {os.path.getsize(os.path.join(processed_dir, 'faiss_index.bin'))} bytes")
+        else:
+            missing_files.append('shards/')
+            logger.error("❌ Missing FAISS index (shards/ or faiss_index.bin)")
+        
         if missing_files:
             logger.error(f"❌ Cannot initialize search system. Missing files: {missing_files}")
-            return False
+            return None
         
         # Try to initialize the search system
         logger.info("🤖 Loading AdvancedESCSearch...")
         from advanced_search_system import AdvancedESCSearch
         
         logger.info("🔧 Creating search system instance...")
-        # Assign to the global variable
-        search_system = AdvancedESCSearch()
+        system = AdvancedESCSearch()
         
         logger.info("✅ Search system initialized successfully!")
-        return True
+        return system
         
     except ImportError as e:
         logger.error(f"❌ Import error: {e}")
-        return False
+        return None
     except Exception as e:
         logger.error(f"❌ Failed to initialize search system: {e}")
         logger.error(f"❌ Error type: {type(e).__name__}")
         import traceback
         logger.error(f"❌ Traceback: {traceback.format_exc()}")
-        return False
+        return None
+
+@app.before_request
+def start_worker_threads():
+    """Background threads are started per process, on its first request"""
+    start_reload_watcher()
 
 @app.route('/')
 def index():
@@ -331,7 +657,8 @@ def index():
 @app.route('/search', methods=['POST'])
 def search():
     """Main search endpoint"""
-    if not search_system:
+    system = search_system
+    if not system:
         return jsonify({
             'error': 'Search system is initializing. Please try again in a moment.',
             'retry': True
@@ -341,26 +668,104 @@ def search():
         data = request.get_json()
         query = data.get('query', '')
         top_k = data.get('top_k', 10)
+        expand_query = data.get('expand_query', True)
+        filter_guideline = data.get('filter_guideline') or None
+        mode = data.get('mode', 'full')
         
         if not query:
             return jsonify({'error': 'Query is required'}), 400
+        error = search_params_error(top_k, filter_guideline, expand_query)
+        if error:
+            return jsonify({'error': error}), 400
+        if mode not in SEARCH_MODES:
+            return jsonify({'error': f"mode must be one of {', '.join(SEARCH_MODES)}"}), 400
         
-        results = search_system.search(query, top_k=top_k)
+        return cached_json_response(system, 'search', {'query': query, 'top_k': top_k, 'expand_query': expand_query,
+                                               'filter_guideline': filter_guideline, 'mode': mode},
+                                    lambda: search_response(system, query, top_k, expand_query, filter_guideline, mode))
         
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """Batch search endpoint: many queries, one batched encode and FAISS search"""
+    system = search_system
+    if not system:
         return jsonify({
-            'query': query,
-            'total_results': len(results),
-            'results': results
-        })
+            'error': 'Search system is initializing. Please try again in a moment.',
+            'retry': True
+        }), 503
+    
+    try:
+        data = request.get_json()
+        queries = data.get('queries', [])
+        top_k = data.get('top_k', 10)
+        expand_query = data.get('expand_query', True)
+        mode = data.get('mode', 'full')
+        
+        if not queries or not isinstance(queries, list):
+            return jsonify({'error': 'queries must be a non-empty list'}), 400
+        if mode not in SEARCH_MODES:
+            return jsonify({'error': f"mode must be one of {', '.join(SEARCH_MODES)}"}), 400
+        if len(queries) > MAX_BATCH_QUERIES:
+            return jsonify({'error': f'At most {MAX_BATCH_QUERIES} queries per batch'}), 400
+        
+        error = search_params_error(top_k, expand_query=expand_query)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        # Each entry is a query string or {"query", "top_k", "expand_query", "filter_guideline"}
+        for item in queries:
+            if isinstance(item, dict):
+                if not (isinstance(item.get('query'), str) and item['query']):
+                    return jsonify({'error': 'Every entry needs a query'}), 400
+                error = search_params_error(item.get('top_k', top_k), item.get('filter_guideline'),
+                                            item.get('expand_query', expand_query))
+                if error:
+                    return jsonify({'error': f"{item['query']!r}: {error}"}), 400
+            elif not (isinstance(item, str) and item):
+                return jsonify({'error': 'Every entry needs a query'}), 400
+        
+        def query_text(item):
+            return item if isinstance(item, str) else item['query']
+        
+        if data.get('stream'):
+            # Newline-delimited JSON, one line per query in input order
+            def generate():
+                for start in range(0, len(queries), BATCH_STREAM_SIZE):
+                    part = queries[start:start + BATCH_STREAM_SIZE]
+                    for item, results in zip(part, system.search_many(part, top_k=top_k,
+                                                                      expand_query=expand_query)):
+                        yield app.json.dumps({
+                            'query': query_text(item),
+                            'total_results': len(results),
+                            'results': format_results(results, mode)
+                        }) + "\n"
+            
+            return Response(generate(), mimetype='application/x-ndjson')
         
+        all_results = system.search_many(queries, top_k=top_k, expand_query=expand_query)
+        
+        return jsonify({
+            'total_queries': len(queries),
+            'results': [{
+                'query': query_text(item),
+                'total_results': len(results),
+                'results': format_results(results, mode)
+            } for item, results in zip(queries, all_results)]
+        })
+    
     except Exception as e:
-        logger.error(f"Search error: {e}")
+        logger.error(f"Batch search error: {e}")
         return jsonify({'error': str(e)}), 500
 
 @app.route('/clinical-search', methods=['POST'])
 def clinical_search():
     """Clinical question search endpoint"""
-    if not search_system:
+    system = search_system
+    if not system:
         return jsonify({
             'error': 'Search system is initializing. Please try again in a moment.',
             'retry': True
@@ -373,9 +778,12 @@ def clinical_search():
         
         if not question:
             return jsonify({'error': 'Question is required'}), 400
+        error = search_params_error(top_k)
+        if error:
+            return jsonify({'error': error}), 400
         
-        result = search_system.clinical_question_search(question, top_k=top_k)
-        return jsonify(result)
+        return cached_json_response(system, 'clinical-search', {'question': question, 'top_k': top_k},
+                                    lambda: system.clinical_question_search(question, top_k=top_k))
         
     except Exception as e:
         logger.error(f"Clinical search error: {e}")
@@ -384,48 +792,82 @@ def clinical_search():
 @app.route('/documents', methods=['GET'])
 def get_documents():
     """Get list of available documents"""
-    if not search_system:
+    system = search_system
+    if not system:
         return jsonify({
             'error': 'Search system not initialized',
             'setup_required': True
         }), 503
     
     try:
-        documents = []
-        for doc_name in search_system.metadata.keys():
-            summary = search_system.get_document_summary(doc_name)
-            documents.append(summary)
-        
-        return jsonify({
-            'total_documents': len(documents),
-            'documents': documents
-        })
+        return jsonify(documents_response(system))
         
     except Exception as e:
         logger.error(f"Documents error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/chunks/<path:chunk_id>', methods=['GET'])
+def get_chunk(chunk_id):
+    """Full text and metadata of one chunk, e.g. for a result fetched in snippet mode"""
+    system = search_system
+    if not system:
+        return jsonify({
+            'error': 'Search system not initialized',
+            'setup_required': True
+        }), 503
+    
+    chunk = system.get_chunk(chunk_id)
+    if chunk is None:
+        return jsonify({'error': f'Chunk not found: {chunk_id}'}), 404
+    
+    response = jsonify(chunk)
+    response.set_etag(chunk_etag(system, chunk_id))
+    response.cache_control.public = True
+    response.cache_control.max_age = CHUNK_MAX_AGE
+    return response.make_conditional(request)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
+    system = search_system
     try:
-        if search_system:
-            return jsonify({
-                'status': 'healthy',
-                'total_chunks': len(search_system.chunks),
-                'total_documents': len(search_system.metadata),
-                'index_size': search_system.index.ntotal if search_system.index else 0
-            })
-        else:
-            return jsonify({
-                'status': 'setup_required',
-                'message': 'Search system not initialized. Data processing required.'
-            })
+        return jsonify(health_response(system))
         
     except Exception as e:
         logger.error(f"Health check error: {e}")
         return jsonify({'status': 'unhealthy', 'error': str(e)}), 500
 
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness probe: the process is up and answering requests"""
+    return jsonify({'live': True})
+
+@app.route('/health/ready', methods=['GET'])
+def readiness_check():
+    """Readiness probe: 503 until the data and model are loaded and warmed up"""
+    body, status = readiness_response(search_system)
+    return jsonify(body), status
+
+@app.route('/admin/reload', methods=['GET', 'POST'])
+def admin_reload():
+    """Start a background reload of the processed data (POST) or report reload status (GET)"""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled. Set ADMIN_TOKEN to enable them.'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    
+    system = search_system
+    status = dict(reload_state, serving_version=system.index_version if system else None)
+    
+    if request.method == 'GET':
+        return jsonify(status)
+    
+    if reload_lock.locked():
+        return jsonify(status), 409
+    
+    threading.Thread(target=reload_search_system, name='reload', daemon=True).start()
+    return jsonify(dict(status, status='loading')), 202
+
 @app.route('/diagnostic', methods=['GET'])
 def diagnostic():
     """Detailed diagnostic information for debugging"""
@@ -518,8 +960,9 @@ def setup_status():
     return jsonify(status)
 
 if __name__ == '__main__':
-    # Initialize search system on startup
-    initialize_search_system()
+    # Load and warm up the search system before serving
+    create_app()
+    start_reload_watcher()
     
     # Run the app
     logger.info(f"Starting ESC Guidelines AI Search Tool on port {PORT}")
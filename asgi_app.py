@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+ESC Guidelines AI Search Tool - ASGI Version
+Async variant of the search API for uvicorn: the event loop holds the connections, model inference and FAISS run on a bounded thread pool
+"""
+
+import os
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+from starlette.routing import Route
+import app as web
+
+logger = logging.getLogger(__name__)
+
+# Threads running searches; further requests wait on the event loop without holding a thread
+SEARCH_THREADS = int(os.environ.get('ASGI_SEARCH_THREADS', 4))
+
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix='search')
+
+def json_response(body, status_code=200, cache_status=None) -> Response:
+    """JSON response serialized like the Flask app's, from a dict or an already serialized payload"""
+    payload = body if isinstance(body, bytes) else web.app.json.dumps(body).encode('utf-8')
+    headers = {'X-Cache': cache_status} if cache_status else None
+    return Response(payload, status_code=status_code, media_type='application/json', headers=headers)
+
+async def run_blocking(function, *args):
+    """Run a blocking call (encode, FAISS, SQLite) on the search thread pool"""
+    return await asyncio.get_running_loop().run_in_executor(search_executor, functools.partial(function, *args))
+
+async def index(request: Request) -> Response:
+    """Serve the main search interface"""
+    return HTMLResponse(web.HTML_TEMPLATE)
+
+async def search(request: Request) -> Response:
+    """Main search endpoint"""
+    system = web.search_system
+    if not system:
+        return json_response({
+            'error': 'Search system is initializing. Please try again in a moment.',
+            'retry': True
+        }, 503)
+    
+    try:
+        data = await request.json()
+        query = data.get('query', '')
+        top_k = data.get('top_k', 10)
+        expand_query = data.get('expand_query', True)
+        filter_guideline = data.get('filter_guideline') or None
+        mode = data.get('mode', 'full')
+        
+        if not query:
+            return json_response({'error': 'Query is required'}, 400)
+        error = web.search_params_error(top_k, filter_guideline, expand_query)
+        if error:
+            return json_response({'error': error}, 400)
+        if mode not in web.SEARCH_MODES:
+            return json_response({'error': f"mode must be one of {', '.join(web.SEARCH_MODES)}"}, 400)
+        
+        payload, cache_status = await run_blocking(
+            web.cached_payload, system, 'search',
+            {'query': query, 'top_k': top_k, 'expand_query': expand_query, 'filter_guideline': filter_guideline,
+             'mode': mode},
+            lambda: web.search_response(system, query, top_k, expand_query, filter_guideline, mode))
+        return json_response(payload, cache_status=cache_status)
+    
+    except Exception as e:
+        logger.error(f"Search error: {e}")
+        return json_response({'error': str(e)}, 500)
+
+async def clinical_search(request: Request) -> Response:
+    """Clinical question search endpoint"""
+    system = web.search_system
+    if not system:
+        return json_response({
+            'error': 'Search system is initializing. Please try again in a moment.',
+            'retry': True
+        }, 503)
+    
+    try:
+        data = await request.json()
+        question = data.get('question', '')
+        top_k = data.get('top_k', 8)
+        
+        if not question:
+            return json_response({'error': 'Question is required'}, 400)
+        error = web.search_params_error(top_k)
+        if error:
+            return json_response({'error': error}, 400)
+        
+        payload, cache_status = await run_blocking(
+            web.cached_payload, system, 'clinical-search', {'question': question, 'top_k': top_k},
+            lambda: system.clinical_question_search(question, top_k=top_k))
+        return json_response(payload, cache_status=cache_status)
+    
+    except Exception as e:
+        logger.error(f"Clinical search error: {e}")
+        return json_response({'error': str(e)}, 500)
+
+async def get_documents(request: Request) -> Response:
+    """Get list of available documents"""
+    system = web.search_system
+    if not system:
+        return json_response({
+            'error': 'Search system not initialized',
+            'setup_required': True
+        }, 503)
+    
+    try:
+        return json_response(await run_blocking(web.documents_response, system))
+    
+    except Exception as e:
+        logger.error(f"Documents error: {e}")
+        return json_response({'error': str(e)}, 500)
+
+async def get_chunk(request: Request) -> Response:
+    """Full text and metadata of one chunk, e.g. for a result fetched in snippet mode"""
+    system = web.search_system
+    if not system:
+        return json_response({
+            'error': 'Search system not initialized',
+            'setup_required': True
+        }, 503)
+    
+    chunk_id = request.path_params['chunk_id']
+    chunk = system.get_chunk(chunk_id)
+    if chunk is None:
+        return json_response({'error': f'Chunk not found: {chunk_id}'}, 404)
+    
+    etag = f'"{web.chunk_etag(system, chunk_id)}"'
+    headers = {'ETag': etag, 'Cache-Control': f'public, max-age={web.CHUNK_MAX_AGE}'}
+    if etag in [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    
+    response = json_response(chunk)
+    response.headers.update(headers)
+    return response
+
+async def health_check(request: Request) -> Response:
+    """Health check endpoint"""
+    try:
+        return json_response(web.health_response(web.search_system))
+    
+    except Exception as e:
+        logger.error(f"Health check error: {e}")
+        return json_response({'status': 'unhealthy', 'error': str(e)}, 500)
+
+async def liveness_check(request: Request) -> Response:
+    """Liveness probe: the event loop is up and answering requests"""
+    return json_response({'live': True})
+
+async def readiness_check(request: Request) -> Response:
+    """Readiness probe: 503 until the data and model are loaded and warmed up"""
+    body, status = web.readiness_response(web.search_system)
+    return json_response(body, status)
+
+@asynccontextmanager
+async def lifespan(_):
+    """Load and warm up the search system before uvicorn accepts connections"""
+    await run_blocking(web.create_app)
+    web.start_reload_watcher()
+    yield
+    search_executor.shutdown(wait=False)
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/search', search, methods=['POST']),
+        Route('/clinical-search', clinical_search, methods=['POST']),
+        Route('/documents', get_documents, methods=['GET']),
+        Route('/chunks/{chunk_id:path}', get_chunk, methods=['GET']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/health/live', liveness_check, methods=['GET']),
+        Route('/health/ready', readiness_check, methods=['GET'])
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    
+    logger.info(f"Starting ESC Guidelines AI Search Tool (ASGI) on port {web.PORT}")
+    uvicorn.run(app, host='0.0.0.0', port=web.PORT)
@@ -142,7 +142,7 @@ def main():
     run_command("pip install --no-cache-dir sentence-transformers faiss-cpu", "Installing processing dependencies")
     
     # Run the processor
-    if run_command("python esc_guidelines_processor.py", "Processing ESC Guidelines", cwd="."):
+    if run_command("INDEX_REPORT=1 python esc_guidelines_processor.py", "Processing ESC Guidelines", cwd="."):
         logger.info("✅ ESC Guidelines processed successfully!")
         
         # Verify processed data
@@ -162,6 +162,17 @@ def main():
                     
             logger.info(f"📊 Processed {chunk_count} chunks from {doc_count} documents")
         
+        # Show how the index options compare on this corpus
+        report_file = processed_dir / "index_report.json"
+        if report_file.exists():
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+            
+            logger.info("📊 FAISS index options (recall@k vs exact search):")
+            for row in report:
+                logger.info(f"   - {row['spec']}: recall@{row['k']} {row['recall_at_k']:.3f}, "
+                            f"{row['memory_bytes'] / 1024 / 1024:.1f} MB, {row['latency_ms']:.2f} ms/query")
+        
         return True
     else:
         logger.error("❌ Failed to process ESC Guidelines")
@@ -0,0 +1,233 @@
+"""
+Columnar chunk table for ESC Guidelines search snapshots
+Stored as a single file opened with mmap, so worker processes share its pages and start without parsing JSON
+"""
+
+import os
+import json
+import mmap
+import struct
+import logging
+from typing import List, Dict, Iterator, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'ESCCHNK\x01'
+FORMAT_VERSION = 2
+
+# Layout: MAGIC | uint64 header length | JSON header | 8-byte aligned sections.
+# The header holds the interned document and section names, and its layout
+# maps each stored array to [offset, length in bytes, numpy dtype].
+
+# Per-chunk integer columns
+COLUMNS = (
+    ('document_ids', '<u4'),
+    ('section_ids', '<u4'),
+    ('page_numbers', '<i4'),
+    ('page_ends', '<i4'),
+    ('chunk_numbers', '<i4'),
+    ('word_counts', '<i4'),
+    ('char_counts', '<i4'),
+)
+
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+class ChunkTable:
+    """
+    Compact, read-only table of chunks: interned document and section names,
+    integer columns in numpy arrays and chunk texts in one UTF-8 buffer.
+    Behaves like the list of chunk dicts loaded from chunks.json, but a dict
+    is only built when a row is accessed.
+    """
+    
+    def __init__(self, documents: List[str], sections: List[str], columns: Dict[str, np.ndarray],
+                 text_offsets: np.ndarray, text_buffer):
+        self.documents = documents
+        self.sections = sections
+        self.text_offsets = text_offsets
+        self._text = memoryview(text_buffer)
+        
+        for name, _ in COLUMNS:
+            setattr(self, name, columns[name])
+        
+        self._document_lookup = {name: i for i, name in enumerate(documents)}
+        self._chunk_rows: Optional[Dict[str, int]] = None
+    
+    @classmethod
+    def from_chunks(cls, chunks: List[Dict]) -> 'ChunkTable':
+        """
+        Build a table in memory from chunk dicts
+        """
+        documents = {}
+        sections = {}
+        columns = {name: np.zeros(len(chunks), dtype=dtype) for name, dtype in COLUMNS}
+        texts = []
+        
+        for i, chunk in enumerate(chunks):
+            columns['document_ids'][i] = documents.setdefault(chunk['document_name'], len(documents))
+            columns['section_ids'][i] = sections.setdefault(chunk.get('section_title', 'General'), len(sections))
+            columns['page_numbers'][i] = chunk['page_number']
+            columns['page_ends'][i] = chunk.get('page_end', chunk['page_number'])
+            columns['chunk_numbers'][i] = chunk['chunk_number']
+            columns['word_counts'][i] = chunk['word_count']
+            columns['char_counts'][i] = chunk['char_count']
+            texts.append(chunk['text'].encode('utf-8'))
+        
+        text_offsets = np.zeros(len(chunks) + 1, dtype='<u8')
+        text_offsets[1:] = np.cumsum([len(text) for text in texts], dtype='<u8')
+        
+        return cls(list(documents), list(sections), columns, text_offsets, b''.join(texts))
+    
+    @classmethod
+    def open(cls, path: str) -> 'ChunkTable':
+        """
+        Memory-map a table written by save(); columns are zero-copy views of the file
+        """
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a chunk table file")
+        
+        header_size = struct.unpack_from('<Q', mm, len(MAGIC))[0]
+        start = len(MAGIC) + 8
+        header = json.loads(bytes(mm[start:start + header_size]))
+        
+        if header['version'] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported chunk table version {header['version']} in {path}")
+        
+        def section(name):
+            offset, length, dtype = header['layout'][name]
+            dtype = np.dtype(dtype)
+            return np.frombuffer(mm, dtype=dtype, count=length // dtype.itemsize, offset=offset)
+        
+        columns = {name: section(name) for name, _ in COLUMNS}
+        text_offset, text_length, _ = header['layout']['text']
+        text_buffer = memoryview(mm)[text_offset:text_offset + text_length]
+        
+        return cls(header['documents'], header['section_titles'], columns, section('text_offsets'), text_buffer)
+    
+    def save(self, path: str):
+        """
+        Write the table to a single mmap-friendly file, replacing `path` atomically
+        """
+        sections = [(name, np.ascontiguousarray(getattr(self, name), dtype=dtype).tobytes(), dtype)
+                    for name, dtype in COLUMNS]
+        sections.append(('text_offsets', np.ascontiguousarray(self.text_offsets, dtype='<u8').tobytes(), '<u8'))
+        sections.append(('text', self._text.tobytes(), 'u1'))
+        
+        # The header size depends on the offsets it contains, so lay out until it stops growing
+        header_size = 0
+        while True:
+            position = _align(len(MAGIC) + 8 + header_size)
+            table = {}
+            for name, data, dtype in sections:
+                table[name] = [position, len(data), dtype]
+                position = _align(position + len(data))
+            
+            header = json.dumps({
+                'version': FORMAT_VERSION,
+                'count': len(self),
+                'documents': self.documents,
+                'section_titles': self.sections,
+                'layout': table
+            }, ensure_ascii=False).encode('utf-8')
+            if len(header) <= header_size:
+                break
+            header_size = len(header)
+        
+        header = header.ljust(header_size)
+        
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            for name, data, _ in sections:
+                f.seek(table[name][0])
+                f.write(data)
+        
+        # Replace atomically; processes that still map the old file keep reading it
+        os.replace(tmp_path, path)
+    
+    def __len__(self) -> int:
+        return len(self.text_offsets) - 1
+    
+    def _row(self, index: int) -> int:
+        index = int(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("chunk index out of range")
+        return index
+    
+    def text(self, index: int) -> str:
+        """Text of one chunk, decoded from the buffer"""
+        index = self._row(index)
+        return str(self._text[int(self.text_offsets[index]):int(self.text_offsets[index + 1])], 'utf-8')
+    
+    def document_name(self, index: int) -> str:
+        return self.documents[self.document_ids[self._row(index)]]
+    
+    def section_title(self, index: int) -> str:
+        return self.sections[self.section_ids[self._row(index)]]
+    
+    def chunk_id(self, index: int) -> str:
+        index = self._row(index)
+        return f"{self.document_name(index)}_page{self.page_numbers[index]}_chunk{self.chunk_numbers[index]}"
+    
+    def find_row(self, chunk_id: str) -> Optional[int]:
+        """Row of a chunk id, or None; the id map is built on first use"""
+        if self._chunk_rows is None:
+            self._chunk_rows = {self.chunk_id(i): i for i in range(len(self))}
+        return self._chunk_rows.get(chunk_id)
+    
+    def document_rows(self, document_name: str) -> np.ndarray:
+        """Row numbers of all chunks of a document, in order"""
+        document_id = self._document_lookup.get(document_name)
+        if document_id is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.document_ids == document_id)
+    
+    def __getitem__(self, index: int) -> Dict:
+        """Materialize one row as a chunk dict with the same keys as chunks.json"""
+        index = self._row(index)
+        return {
+            'chunk_id': self.chunk_id(index),
+            'document_name': self.document_name(index),
+            'page_number': int(self.page_numbers[index]),
+            'page_end': int(self.page_ends[index]),
+            'chunk_number': int(self.chunk_numbers[index]),
+            'text': self.text(index),
+            'section_title': self.section_title(index),
+            'word_count': int(self.word_counts[index]),
+            'char_count': int(self.char_counts[index])
+        }
+    
+    def __iter__(self) -> Iterator[Dict]:
+        for index in range(len(self)):
+            yield self[index]
+
+def write_chunk_store(path: str, chunks: List[Dict]):
+    """
+    Write chunk dicts to a chunk table file
+    """
+    ChunkTable.from_chunks(chunks).save(path)
+
+def load_chunk_table(store_path: str, json_path: Optional[str] = None) -> ChunkTable:
+    """
+    Open the memory-mapped chunk table, or build one from chunks.json when the
+    binary file is missing or from an older format
+    """
+    if os.path.exists(store_path):
+        try:
+            return ChunkTable.open(store_path)
+        except ValueError as e:
+            if not json_path:
+                raise
+            logger.warning(f"{e}; loading {json_path} instead")
+    
+    with open(json_path, 'r', encoding='utf-8') as f:
+        return ChunkTable.from_chunks(json.load(f))
@@ -0,0 +1,330 @@
+"""
+Embedding caches for ESC Guidelines search
+Persistent content-addressed cache of chunk vectors, and an in-memory LRU cache of query vectors
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Default size cap for the vector file
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Default number of query vectors kept by QueryEmbeddingCache
+DEFAULT_QUERY_CACHE_SIZE = 1024
+
+class EmbeddingCache:
+    """
+    On-disk cache of text embeddings keyed by model name plus a hash of the text.
+
+    Vectors live in a single float32 file opened with np.memmap; a small JSON
+    index maps each key to its row and a last-used generation. When the file
+    reaches its size cap, the least recently used rows are evicted and reused.
+    """
+    
+    def __init__(self, cache_dir: str, model_name: str, dimension: int,
+                 max_bytes: int = DEFAULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        self.dimension = dimension
+        self.capacity = max(1, max_bytes // (dimension * 4))
+        self.vectors_file = os.path.join(cache_dir, "vectors.f32")
+        self.index_file = os.path.join(cache_dir, "index.json")
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        
+        # key -> [row, last_used generation]
+        self.entries: Dict[str, List[int]] = {}
+        self.generation = 0
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        self._vectors = None
+        
+        self._load()
+    
+    def _load(self):
+        """Load the cache index and map the vector file"""
+        if os.path.exists(self.index_file) and os.path.exists(self.vectors_file):
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    index = json.load(f)
+                
+                if index.get('dimension') == self.dimension:
+                    self.entries = index['entries']
+                    self.generation = index['generation']
+                    self.rows = os.path.getsize(self.vectors_file) // (self.dimension * 4)
+                else:
+                    logger.info("Embedding cache dimension changed, starting a new cache")
+            except Exception as e:
+                logger.warning(f"Could not read embedding cache index, starting a new cache: {e}")
+                self.entries = {}
+        
+        # Drop entries pointing past the end of a truncated vector file
+        self.entries = {key: entry for key, entry in self.entries.items() if entry[0] < self.rows}
+        if not self.entries:
+            self.generation = 0
+            self.rows = 0
+            open(self.vectors_file, 'wb').close()
+        
+        self._free_rows = sorted(set(range(self.rows)) - {entry[0] for entry in self.entries.values()}, reverse=True)
+        self._map()
+        
+        logger.info(f"Embedding cache: {len(self.entries)} vectors in {self.cache_dir}")
+    
+    def _map(self):
+        """(Re)open the vector file as a writable memory map"""
+        self._vectors = None
+        if self.rows:
+            self._vectors = np.memmap(self.vectors_file, dtype=np.float32, mode='r+',
+                                      shape=(self.rows, self.dimension))
+    
+    def _grow(self, needed: int):
+        """Extend the vector file by at least `needed` rows, up to the capacity"""
+        new_rows = min(self.capacity, max(self.rows + needed, self.rows * 2, 1024))
+        if new_rows <= self.rows:
+            return
+        
+        if self._vectors is not None:
+            self._vectors.flush()
+        with open(self.vectors_file, 'r+b') as f:
+            f.truncate(new_rows * self.dimension * 4)
+        
+        self._free_rows.extend(range(new_rows - 1, self.rows - 1, -1))
+        self.rows = new_rows
+        self._map()
+    
+    def key(self, text: str) -> str:
+        """Content address of a text for this cache's model"""
+        return hashlib.blake2b(f"{self.model_name}\0{text}".encode('utf-8'), digest_size=16).hexdigest()
+    
+    def lookup(self, texts: List[str], out: np.ndarray) -> List[int]:
+        """
+        Copy cached vectors into the matching rows of `out` and return the
+        positions of texts that still need to be encoded
+        """
+        self.generation += 1
+        missing = []
+        
+        for i, text in enumerate(texts):
+            entry = self.entries.get(self.key(text))
+            if entry is None:
+                missing.append(i)
+                continue
+            
+            out[i] = self._vectors[entry[0]]
+            entry[1] = self.generation
+        
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return missing
+    
+    def store(self, texts: List[str], vectors: np.ndarray):
+        """Add freshly encoded vectors, evicting least recently used rows if full"""
+        keys = [key for key in dict.fromkeys(self.key(text) for text in texts) if key not in self.entries]
+        if not keys:
+            return
+        
+        positions = {self.key(text): i for i, text in enumerate(texts)}
+        keys = keys[-self.capacity:]
+        
+        if len(self._free_rows) < len(keys):
+            self._grow(len(keys) - len(self._free_rows))
+        
+        shortfall = len(keys) - len(self._free_rows)
+        if shortfall > 0:
+            self._evict(shortfall)
+        
+        for key in keys:
+            row = self._free_rows.pop()
+            self._vectors[row] = vectors[positions[key]]
+            self.entries[key] = [row, self.generation]
+    
+    def _evict(self, count: int):
+        """Release the `count` least recently used rows"""
+        victims = sorted(self.entries.items(), key=lambda item: item[1][1])[:count]
+        for key, (row, _) in victims:
+            del self.entries[key]
+            self._free_rows.append(row)
+        
+        # Persist the removals before the rows are overwritten so a crash
+        # cannot leave old keys pointing at new vectors
+        self._write_index()
+        logger.info(f"Evicted {len(victims)} vectors from embedding cache")
+    
+    def save(self):
+        """Flush vectors and write the index"""
+        if self._vectors is not None:
+            self._vectors.flush()
+        self._write_index()
+        
+        total = self.hits + self.misses
+        if total:
+            logger.info(f"Embedding cache: {self.hits}/{total} hits, {len(self.entries)} vectors stored")
+    
+    def _write_index(self):
+        """Atomically replace the JSON index"""
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump({
+                'model': self.model_name,
+                'dimension': self.dimension,
+                'generation': self.generation,
+                'entries': self.entries
+            }, f)
+        os.replace(tmp_file, self.index_file)
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of query embeddings, keyed on the normalized query
+    string. Safe to share between request threads. When a path is given,
+    entries are loaded from and saved to a .npz file so frequent queries
+    stay warm across restarts. Several processes (gunicorn workers) can
+    share the file: a forked process first loads what the others saved, and
+    save() merges into the file instead of overwriting it.
+    """
+    
+    def __init__(self, max_entries: int = DEFAULT_QUERY_CACHE_SIZE, path: Optional[str] = None):
+        self.max_entries = max(0, max_entries)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        
+        # Entries added since the last load or save; save() does nothing without them
+        self.changed = False
+        
+        if path and os.path.exists(path):
+            self._load()
+    
+    @staticmethod
+    def key(query: str) -> str:
+        """Case- and whitespace-insensitive key; the embedding model is uncased"""
+        return ' '.join(query.lower().split())
+    
+    def get(self, query: str) -> Optional[np.ndarray]:
+        """Cached vector for a query, or None; counts a hit or a miss"""
+        self._check_fork()
+        key = self.key(query)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+    
+    def put(self, query: str, vector: np.ndarray):
+        """Store a vector, evicting the least recently used entries beyond the size cap"""
+        if not self.max_entries:
+            return
+        
+        self._check_fork()
+        self._store(self.key(query), vector)
+        self.changed = True
+    
+    def _store(self, key: str, vector: np.ndarray):
+        """Insert or refresh an entry and evict beyond the size cap"""
+        vector = np.array(vector, dtype=np.float32).reshape(-1)
+        vector.setflags(write=False)
+        
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+    
+    def _check_fork(self):
+        """
+        In a process forked from the one that built the cache (a gunicorn
+        worker, or its replacement after --max-requests), load the entries
+        other workers saved on top of the ones inherited at fork time
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._pid = pid
+            self.hits = 0
+            self.misses = 0
+            self.changed = False
+        
+        if self.path and os.path.exists(self.path):
+            self._load()
+    
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+    
+    def _read_file(self) -> List[Tuple[str, np.ndarray]]:
+        """Entries saved in the cache file, oldest first"""
+        with np.load(self.path) as data:
+            return list(zip(data['keys'].tolist(), data['vectors']))
+    
+    def _load(self):
+        """Load entries saved by save(), oldest first"""
+        try:
+            for key, vector in self._read_file():
+                self._store(key, vector)
+            logger.info(f"Query embedding cache: loaded {len(self._entries)} vectors from {self.path}")
+        except Exception as e:
+            logger.warning(f"Could not read query embedding cache {self.path}: {e}")
+    
+    def save(self):
+        """
+        Merge this process's entries into the cache file, if one is configured
+        and entries were added. Entries other processes saved meanwhile are
+        kept (this process's count as more recent), and each process writes
+        its own temporary file before the atomic replace.
+        """
+        # A forked process that never used the cache has nothing of its own to add
+        if not self.path or not self.changed or self._pid != os.getpid():
+            return
+        
+        merged: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        if os.path.exists(self.path):
+            try:
+                merged.update(self._read_file())
+            except Exception as e:
+                logger.warning(f"Could not read query embedding cache {self.path}, overwriting it: {e}")
+        
+        with self._lock:
+            for key, vector in self._entries.items():
+                merged[key] = vector
+                merged.move_to_end(key)
+            self.changed = False
+        
+        while len(merged) > self.max_entries:
+            merged.popitem(last=False)
+        
+        keys = list(merged)
+        vectors = np.stack(list(merged.values())) if keys else np.zeros((0, 0), dtype=np.float32)
+        
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, keys=np.array(keys, dtype=str), vectors=vectors)
+        os.replace(tmp_path, self.path)
+        
+        logger.info(f"Query embedding cache: saved {len(keys)} vectors to {self.path}")
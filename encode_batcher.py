@@ -0,0 +1,140 @@
+"""
+Micro-batching of query encodes for ESC Guidelines search
+Concurrent requests share one forward pass of the embedding model instead of queuing for one pass each
+"""
+
+import logging
+import threading
+from typing import Callable, Dict, List, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Milliseconds the first request of a batch waits for others to join while another pass is busy (0 disables batching)
+DEFAULT_BATCH_WINDOW_MS = 5.0
+
+# Texts encoded together in one forward pass at most
+DEFAULT_MAX_BATCH_SIZE = 64
+
+class _Batch:
+    """Texts collected for one forward pass and the outcome shared by their callers"""
+    
+    __slots__ = ('texts', 'full', 'done', 'result', 'error')
+    
+    def __init__(self):
+        self.texts: List[str] = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+
+class EncodeBatcher:
+    """
+    Collects concurrent encode() calls into batches for an encode function.
+
+    The first caller to find no open batch becomes its leader. A leader with
+    no other pass running or queued encodes at once; otherwise it waits up to
+    the batch window (less if the batch fills up) while others join. It then
+    runs the encode for every text in the batch and wakes the other callers,
+    which each take their own slice of the result. The batch stays open until
+    the leader gets the model, so requests keep joining while a previous pass
+    is running, and a lone request never pays the window.
+    No background thread is involved, so the batcher keeps working in
+    workers forked from a preloaded gunicorn master.
+    """
+    
+    def __init__(self, encode: Callable[[List[str]], np.ndarray],
+                 window_ms: float = DEFAULT_BATCH_WINDOW_MS, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE):
+        self._encode = encode
+        self.window = max(0.0, window_ms) / 1000
+        self.max_batch_size = max(1, max_batch_size)
+        self._open: Optional[_Batch] = None
+        self._pending = 0  # batches running or waiting for the model
+        self._lock = threading.Lock()
+        self._model_lock = threading.Lock()
+        
+        # Metrics
+        self.batches = 0
+        self.texts = 0
+        self.largest_batch = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+    
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """Embeddings of texts, one row per text, computed in a shared batch"""
+        texts = list(texts)
+        if not self.window:
+            return self._run(texts)
+        
+        with self._lock:
+            batch = self._open
+            if batch is not None and len(batch.texts) + len(texts) > self.max_batch_size:
+                # No room left: the waiting leader can start now, and this caller opens the next batch
+                batch.full.set()
+                batch = None
+            
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+                busy = self._pending > 0
+                self._pending += 1
+            
+            start = len(batch.texts)
+            batch.texts.extend(texts)
+            self.queue_depth += len(texts)
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            if len(batch.texts) >= self.max_batch_size:
+                batch.full.set()
+        
+        if leader:
+            if busy:
+                batch.full.wait(self.window)
+            with self._model_lock:
+                with self._lock:
+                    if self._open is batch:
+                        self._open = None
+                    self.queue_depth -= len(batch.texts)
+                
+                try:
+                    batch.result = self._run(batch.texts)
+                except BaseException as e:
+                    batch.error = e
+                finally:
+                    with self._lock:
+                        self._pending -= 1
+                    batch.done.set()
+        else:
+            batch.done.wait()
+        
+        if batch.error is not None:
+            raise batch.error
+        return batch.result[start:start + len(texts)]
+    
+    def _run(self, texts: List[str]) -> np.ndarray:
+        """One encode call over the distinct texts, expanded back to input order"""
+        unique = list(dict.fromkeys(texts))
+        vectors = np.asarray(self._encode(unique))
+        
+        with self._lock:
+            self.batches += 1
+            self.texts += len(texts)
+            self.largest_batch = max(self.largest_batch, len(texts))
+        
+        if len(unique) == len(texts):
+            return vectors
+        rows = {text: i for i, text in enumerate(unique)}
+        return vectors[[rows[text] for text in texts]]
+    
+    def stats(self) -> Dict:
+        """Batch sizes and queue depth (texts waiting for a forward pass)"""
+        with self._lock:
+            return {
+                'window_ms': self.window * 1000,
+                'max_batch_size': self.max_batch_size,
+                'batches': self.batches,
+                'texts': self.texts,
+                'mean_batch_size': self.texts / self.batches if self.batches else 0.0,
+                'largest_batch': self.largest_batch,
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth
+            }
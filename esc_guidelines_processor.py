@@ -6,44 +6,119 @@ Implementation of the methodology described in the uploaded document
 
 import os
 import json
-import re
+import hashlib
+import time
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
 import pdfplumber
-from sentence_transformers import SentenceTransformer
 import faiss
 import numpy as np
 from typing import List, Dict, Tuple, Optional
 import logging
 from datetime import datetime
+from embedding_cache import EmbeddingCache, DEFAULT_CACHE_MAX_BYTES
+from chunk_store import write_chunk_store
+from pdf_ingest import extract_page_range, chunk_text, iter_chunks, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS
+from lexical_index import BM25Index
+from vector_index import (build_sharded_index, is_inner_product, normalize, reconstruct_all, describe_index,
+                          benchmark_index_specs, format_index_report, ShardedIndex, load_sharded_index,
+                          shard_file, nearest_neighbors, save_neighbor_table, DEFAULT_INDEX_SPEC, SHARD_DIR)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Sentence embedding model used for chunks and queries
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+# Embedding batches are sized so that batch size x padded token length stays under this budget
+EMBEDDING_BATCH_TOKENS = 16384
+EMBEDDING_MAX_BATCH_SIZE = 256
+
+# Default ingestion processes; os.cpu_count() reports the host's CPUs inside a container
+DEFAULT_INGEST_WORKERS = min(4, os.cpu_count() or 1)
+
+# Pages per extraction task when a large PDF is split across workers
+PAGES_PER_TASK = 40
+
+# Similar chunks precomputed per chunk for "more like this" lookups
+NEIGHBOR_TABLE_SIZE = 10
+
+# Bumped whenever chunking output changes so incremental builds re-chunk every PDF
+CHUNKER_VERSION = 4
+
 class ESCGuidelinesProcessor:
     """
     Main class for processing ESC Guidelines PDFs and building searchable index
     """
     
     def __init__(self, guidelines_dir: str = "ESC_Guidelines", 
-                 output_dir: str = "processed_guidelines"):
+                 output_dir: str = "processed_guidelines",
+                 workers: int = 1, pages_per_task: int = PAGES_PER_TASK,
+                 embedding_cache_bytes: int = DEFAULT_CACHE_MAX_BYTES,
+                 embedding_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+                 chunk_tokens: int = CHUNK_TOKENS, chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 index_spec: str = DEFAULT_INDEX_SPEC, neighbor_table_size: int = NEIGHBOR_TABLE_SIZE):
         self.guidelines_dir = guidelines_dir
         self.output_dir = output_dir
         self.chunks_file = os.path.join(output_dir, "chunks.json")
+        self.chunk_store_file = os.path.join(output_dir, "chunks.bin")
         self.index_file = os.path.join(output_dir, "faiss_index.bin")
+        self.shard_dir = os.path.join(output_dir, SHARD_DIR)
+        self.lexical_index_file = os.path.join(output_dir, "bm25_index.npz")
         self.metadata_file = os.path.join(output_dir, "metadata.json")
-        
-        # Initialize embedding model
+        self.manifest_file = os.path.join(output_dir, "manifest.json")
+        self.vectors_file = os.path.join(output_dir, "embeddings.npy")
+        self.neighbors_file = os.path.join(output_dir, "neighbors.npz")
+        self.index_info_file = os.path.join(output_dir, "index_info.json")
+        self.index_report_file = os.path.join(output_dir, "index_report.json")
+        self.version_file = os.path.join(output_dir, "version.json")
+        self.embedding_cache_dir = os.path.join(output_dir, "embedding_cache")
+        
+        # Number of ingestion processes (1 = serial) and page-range size for splitting large PDFs
+        self.workers = max(1, workers)
+        self.pages_per_task = max(1, pages_per_task)
+        
+        # Chunk size target and overlap, in approximate model tokens
+        self.chunk_tokens = max(1, chunk_tokens)
+        self.chunk_overlap_tokens = max(0, min(chunk_overlap_tokens, self.chunk_tokens // 2))
+        
+        # Padded-token budget per embedding forward pass
+        self.embedding_batch_tokens = max(1, embedding_batch_tokens)
+        
+        # FAISS index type: flat, hnsw, hnsw_sq8, ivf_pq or a faiss.index_factory string
+        self.index_spec = index_spec
+        
+        # Nearest neighbors stored per chunk (0 = no neighbor table)
+        self.neighbor_table_size = max(0, neighbor_table_size)
+        
+        # Initialize embedding model; imported here so spawned ingestion workers,
+        # which re-import this module, do not load torch
+        from sentence_transformers import SentenceTransformer
         logger.info("Loading embedding model...")
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
         
         # Create output directory
         os.makedirs(output_dir, exist_ok=True)
         
+        # Persistent cache of chunk embeddings (0 bytes disables it)
+        self.embedding_cache = None
+        if embedding_cache_bytes > 0:
+            self.embedding_cache = EmbeddingCache(self.embedding_cache_dir, EMBEDDING_MODEL_NAME,
+                                                  self.embedding_model.get_sentence_embedding_dimension(),
+                                                  max_bytes=embedding_cache_bytes)
+        
         # Initialize storage
         self.chunks = []
         self.metadata = {}
+        self.manifest = {}
         self.index = None
+        self.index_info = {}
+        self.built_shards = set()
+        self.embeddings = None
+        self.lexical_index = None
     
     def extract_text_from_pdf(self, pdf_path: str) -> List[Dict]:
         """
@@ -51,29 +126,8 @@ class ESCGuidelinesProcessor:
         """
         logger.info(f"Extracting text from {os.path.basename(pdf_path)}")
         
-        pages_data = []
-        
         try:
-            # Use PyMuPDF for fast text extraction with coordinates
-            doc = fitz.open(pdf_path)
-            
-            for page_num in range(len(doc)):
-                page = doc[page_num]
-                text = page.get_text()
-                
-                # Clean and process text
-                text = self._clean_text(text)
-                
-                if text.strip():  # Only add non-empty pages
-                    pages_data.append({
-                        'page_number': page_num + 1,
-                        'text': text,
-                        'char_count': len(text),
-                        'word_count': len(text.split())
-                    })
-            
-            doc.close()
-            
+            pages_data = extract_page_range(pdf_path)
         except Exception as e:
             logger.error(f"Error extracting text from {pdf_path}: {str(e)}")
             return []
@@ -81,135 +135,382 @@ class ESCGuidelinesProcessor:
         logger.info(f"Extracted {len(pages_data)} pages from {os.path.basename(pdf_path)}")
         return pages_data
     
-    def _clean_text(self, text: str) -> str:
+    # Chunking lives in pdf_ingest so pool workers never import the model
+    chunk_text = staticmethod(chunk_text)
+    iter_chunks = staticmethod(iter_chunks)
+    
+    def generate_embeddings(self, chunks: List[Dict]) -> np.ndarray:
         """
-        Clean extracted text
+        Generate embeddings for all chunks
         """
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
+        logger.info(f"Generating embeddings for {len(chunks)} chunks...")
+        
+        texts = [chunk['text'] for chunk in chunks]
+        embeddings = np.zeros((len(texts), self.embedding_model.get_sentence_embedding_dimension()), dtype=np.float32)
+        
+        # Reuse cached vectors and only encode texts that changed
+        missing = list(range(len(texts)))
+        if self.embedding_cache:
+            missing = self.embedding_cache.lookup(texts, embeddings)
+            logger.info(f"Embedding cache hits: {len(texts) - len(missing)}/{len(texts)}")
+        
+        missing_texts = [texts[i] for i in missing]
         
-        # Remove page headers/footers patterns (common in medical guidelines)
-        text = re.sub(r'Page \d+ of \d+', '', text)
-        text = re.sub(r'ESC Guidelines.*?\d{4}', '', text)
+        # Encode straight into the preallocated output rows
+        if missing_texts:
+            self._encode_into(missing_texts, embeddings, missing)
         
-        # Remove URLs and DOIs
-        text = re.sub(r'https?://[^\s]+', '', text)
-        text = re.sub(r'doi:\s*[^\s]+', '', text)
+        if self.embedding_cache:
+            self.embedding_cache.store(missing_texts, embeddings[missing])
+            self.embedding_cache.save()
         
-        return text.strip()
+        return embeddings
     
-    def chunk_text(self, pages_data: List[Dict], document_name: str) -> List[Dict]:
+    def _token_lengths(self, texts: List[str]) -> List[int]:
         """
-        Chunk text into searchable segments with overlap
+        Token count of each text as the model will see it (truncated to max_seq_length)
         """
-        logger.info(f"Chunking text for {document_name}")
-        
-        chunks = []
-        chunk_size = 800  # words per chunk
-        overlap = 100     # words overlap
-        
-        for page_data in pages_data:
-            page_text = page_data['text']
-            page_num = page_data['page_number']
-            words = page_text.split()
+        max_length = self.embedding_model.max_seq_length
+        try:
+            input_ids = self.embedding_model.tokenizer(texts, truncation=True, max_length=max_length)['input_ids']
+            return [len(ids) for ids in input_ids]
+        except Exception as e:
+            # Rough word-piece estimate if the tokenizer is unavailable
+            logger.warning(f"Falling back to estimated token lengths: {e}")
+            return [min(max_length, int(len(text.split()) * 1.3) + 2) for text in texts]
+    
+    def _encode_into(self, texts: List[str], out: np.ndarray, rows: List[int]):
+        """
+        Encode texts sorted by token length, with each batch sized to fit the
+        padded-token budget, writing each vector to out[rows[i]]
+        """
+        lengths = self._token_lengths(texts)
+        
+        # Lengths are capped at max_seq_length, so reaching it means the end of the chunk is not embedded
+        truncated = sum(length >= self.embedding_model.max_seq_length for length in lengths)
+        if truncated:
+            logger.warning(f"{truncated} of {len(texts)} chunks exceed the model's {self.embedding_model.max_seq_length} "
+                           f"token limit and are truncated; lower chunk_tokens")
+        
+        # Longest first: similar lengths share a batch and padding waste stays small
+        order = sorted(range(len(texts)), key=lengths.__getitem__, reverse=True)
+        rows = np.asarray(rows)
+        
+        started = time.perf_counter()
+        batches = 0
+        start = 0
+        
+        while start < len(order):
+            # The first text of a batch is its longest, so it sets the padded length
+            batch_size = self.embedding_batch_tokens // max(1, lengths[order[start]])
+            batch_size = max(1, min(EMBEDDING_MAX_BATCH_SIZE, batch_size))
+            batch = order[start:start + batch_size]
             
-            # Create chunks from this page
-            start = 0
-            chunk_id = 0
+            out[rows[batch]] = self.embedding_model.encode(
+                [texts[i] for i in batch], batch_size=len(batch), show_progress_bar=False)
             
-            while start < len(words):
-                end = min(start + chunk_size, len(words))
-                chunk_text = ' '.join(words[start:end])
-                
-                # Try to detect section headers
-                section_title = self._extract_section_title(chunk_text)
-                
-                chunk = {
-                    'chunk_id': f"{document_name}_page{page_num}_chunk{chunk_id}",
-                    'document_name': document_name,
-                    'page_number': page_num,
-                    'chunk_number': chunk_id,
-                    'text': chunk_text,
-                    'section_title': section_title,
-                    'word_count': len(chunk_text.split()),
-                    'char_count': len(chunk_text)
+            start += len(batch)
+            batches += 1
+        
+        elapsed = max(time.perf_counter() - started, 1e-9)
+        logger.info(f"Encoded {len(texts)} chunks in {batches} batches, {elapsed:.1f}s "
+                    f"({len(texts) / elapsed:.1f} chunks/sec)")
+    
+    def build_faiss_index(self, embeddings: np.ndarray, reuse: Optional[Dict[str, faiss.Index]] = None):
+        """
+        Build FAISS index for fast similarity search: one shard per guideline
+        over its consecutive chunk rows. Shards passed in `reuse` (by document
+        name, built with the current spec) are kept instead of rebuilt.
+        """
+        logger.info("Building FAISS index shards...")
+        
+        # Normalized vectors with inner-product search, so scores are cosine similarities.
+        # The exact vectors are kept as a sidecar so quantized indexes can be rebuilt losslessly.
+        self.embeddings = normalize(embeddings)
+        
+        # Quantizers are trained once on all vectors and copied into each rebuilt shard
+        self.index, built = build_sharded_index(self.embeddings, self._document_ranges(),
+                                                self.index_spec, reuse)
+        self.built_shards = set(built)
+        
+        # Each guideline's metadata points at its shard and global row range
+        for document_name, start, index in zip(self.index.names, self.index.offsets, self.index.shards):
+            if document_name in self.metadata:
+                self.metadata[document_name]['shard'] = {
+                    'file': shard_file(document_name),
+                    'row_offset': int(start),
+                    'total_vectors': index.ntotal,
+                    'index_type': type(index).__name__
                 }
-                
-                chunks.append(chunk)
-                
-                # Move start position with overlap
-                start += chunk_size - overlap
-                chunk_id += 1
-                
-                # Break if we've reached the end
-                if end >= len(words):
-                    break
         
-        logger.info(f"Created {len(chunks)} chunks for {document_name}")
-        return chunks
+        self.index_info = {'spec': self.index_spec, **describe_index(self.index)}
+        
+        logger.info(f"FAISS index built with {self.index.ntotal} vectors in {len(self.index)} shards "
+                    f"({len(self.built_shards)} rebuilt, {self.index_info['shard_type']})")
     
-    def _extract_section_title(self, text: str) -> str:
+    def _document_ranges(self) -> List[Tuple[str, int, int]]:
         """
-        Try to extract section title from chunk text
+        (document name, first row, end row) of each guideline's consecutive chunks
         """
-        lines = text.split('\n')
-        for line in lines[:3]:  # Check first 3 lines
-            line = line.strip()
-            # Look for numbered sections or capitalized headers
-            if re.match(r'^\d+\.?\s+[A-Z][^.]*$', line) or \
-               re.match(r'^[A-Z][A-Z\s]{10,}$', line):
-                return line
-        return "General"
+        ranges = []
+        for row, chunk in enumerate(self.chunks):
+            if ranges and ranges[-1][0] == chunk['document_name']:
+                ranges[-1][2] = row + 1
+            else:
+                ranges.append([chunk['document_name'], row, row + 1])
+        return [tuple(document_range) for document_range in ranges]
     
-    def generate_embeddings(self, chunks: List[Dict]) -> np.ndarray:
+    def build_lexical_index(self):
         """
-        Generate embeddings for all chunks
+        Build the BM25 inverted index over the current chunks
         """
-        logger.info(f"Generating embeddings for {len(chunks)} chunks...")
+        logger.info("Building BM25 lexical index...")
+        self.lexical_index = BM25Index.build([chunk['text'] for chunk in self.chunks])
+    
+    def process_all_guidelines(self):
+        """
+        Process all PDF files in the guidelines directory
+        """
+        logger.info("Starting processing of all ESC Guidelines...")
         
-        texts = [chunk['text'] for chunk in chunks]
+        pdf_files = self._list_pdf_files()
         
-        # Generate embeddings in batches to avoid memory issues
-        batch_size = 32
-        embeddings = []
+        if not pdf_files:
+            logger.error(f"No PDF files found in {self.guidelines_dir}")
+            return
         
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            batch_embeddings = self.embedding_model.encode(batch, show_progress_bar=True)
-            embeddings.extend(batch_embeddings)
+        hashes = {pdf_file: self._file_hash(os.path.join(self.guidelines_dir, pdf_file)) for pdf_file in pdf_files}
+        documents = self._ingest(pdf_files)
         
-        return np.array(embeddings)
-    
-    def build_faiss_index(self, embeddings: np.ndarray):
-        """
-        Build FAISS index for fast similarity search
-        """
-        logger.info("Building FAISS index...")
+        all_chunks = []
+        self.metadata = {}
+        self.manifest = {}
         
-        dimension = embeddings.shape[1]
+        for pdf_file, document_name, total_pages, chunks in documents:
+            self._record_document(pdf_file, document_name, total_pages, chunks, hashes[pdf_file])
+            all_chunks.extend(chunks)
         
-        # Use HNSW index for better performance with large datasets
-        self.index = faiss.IndexHNSWFlat(dimension, 32)
-        self.index.hnsw.efConstruction = 40
+        self.chunks = all_chunks
+        logger.info(f"Total chunks created: {len(all_chunks)}")
         
-        # Add embeddings to index
-        self.index.add(embeddings.astype('float32'))
+        # Generate embeddings
+        embeddings = self.generate_embeddings(all_chunks)
+        
+        # Build FAISS and BM25 indexes
+        self.build_faiss_index(embeddings)
+        self.build_lexical_index()
         
-        logger.info(f"FAISS index built with {self.index.ntotal} vectors")
+        # Save everything
+        self.save_processed_data()
     
-    def process_all_guidelines(self):
+    def update_guidelines(self):
         """
-        Process all PDF files in the guidelines directory
+        Incrementally re-index the guidelines directory. Only PDFs whose content
+        hash differs from the manifest are extracted, chunked and embedded;
+        vectors of unchanged documents are reused from the existing index and
+        those of removed or changed documents are dropped.
         """
-        logger.info("Starting processing of all ESC Guidelines...")
+        have_data = all(os.path.exists(path) for path in (self.manifest_file, self.chunks_file, self.metadata_file))
+        have_index = os.path.isdir(self.shard_dir) or os.path.exists(self.index_file)
+        if not have_data or not have_index:
+            logger.info("No manifest or processed data found. Running full processing...")
+            self.process_all_guidelines()
+            return
         
-        pdf_files = [f for f in os.listdir(self.guidelines_dir) if f.endswith('.pdf')]
+        pdf_files = self._list_pdf_files()
         
         if not pdf_files:
             logger.error(f"No PDF files found in {self.guidelines_dir}")
             return
         
+        self.load_processed_data()
+        if self.index is None:
+            logger.info("No FAISS index found. Running full processing...")
+            self.process_all_guidelines()
+            return
+        
+        old_manifest = self.manifest
+        hashes = {pdf_file: self._file_hash(os.path.join(self.guidelines_dir, pdf_file)) for pdf_file in pdf_files}
+        
+        # A PDF is re-processed when its bytes or the chunking settings changed
+        chunking = self._chunking_signature()
+        changed = [f for f in pdf_files
+                   if old_manifest.get(f, {}).get('sha256') != hashes[f]
+                   or old_manifest[f].get('chunking') != chunking]
+        removed = [f for f in old_manifest if f not in hashes]
+        
+        if not changed and not removed:
+            # Rebuild the index alone for legacy single-file or L2 indexes, or a changed index spec
+            if (not isinstance(self.index, ShardedIndex) or not is_inner_product(self.index)
+                    or self.index_info.get('spec') != self.index_spec):
+                logger.info(f"Rebuilding FAISS index as '{self.index_spec}'")
+                self.build_faiss_index(self._stored_vectors())
+                self.save_processed_data()
+            
+            # Builds from before the lexical index or the neighbor table existed
+            missing = False
+            if not os.path.exists(self.lexical_index_file):
+                self.build_lexical_index()
+                self.lexical_index.save(self.lexical_index_file)
+                missing = True
+            if self.neighbor_table_size and not os.path.exists(self.neighbors_file):
+                self._save_neighbor_table(self._stored_vectors())
+                missing = True
+            if missing:
+                self._write_version()
+            
+            logger.info("All guidelines are up to date, nothing to re-index")
+            return
+        
+        logger.info(f"Re-indexing {len(changed)} new/changed and dropping {len(removed)} removed guidelines "
+                    f"({len(pdf_files) - len(changed)} unchanged)")
+        
+        # Existing vectors, grouped by document so unchanged ones can be carried over
+        old_chunks = self.chunks
+        old_metadata = self.metadata
+        old_vectors = self._stored_vectors()
+        old_rows = {}
+        for row, chunk in enumerate(old_chunks):
+            old_rows.setdefault(chunk['document_name'], []).append(row)
+        
+        # Shards of unchanged guidelines are kept as long as the index spec is the same
+        reusable = isinstance(self.index, ShardedIndex) and self.index_info.get('spec') == self.index_spec
+        reuse = {}
+        
+        # Extract, chunk and embed only what changed
+        new_documents = {document[0]: document for document in self._ingest(changed)}
+        new_chunks = [chunk for pdf_file in changed for chunk in new_documents[pdf_file][3]]
+        new_vectors = self.generate_embeddings(new_chunks) if new_chunks else None
+        new_offset = 0
+        
+        # Reassemble in directory order so the result matches a full rebuild
         all_chunks = []
+        vector_parts = []
+        self.metadata = {}
+        self.manifest = {}
+        
+        for pdf_file in pdf_files:
+            if pdf_file in new_documents:
+                _, document_name, total_pages, chunks = new_documents[pdf_file]
+                self._record_document(pdf_file, document_name, total_pages, chunks, hashes[pdf_file])
+                vector_parts.append(new_vectors[new_offset:new_offset + len(chunks)] if chunks else None)
+                new_offset += len(chunks)
+            else:
+                self.manifest[pdf_file] = old_manifest[pdf_file]
+                document_name = old_manifest[pdf_file]['document_name']
+                rows = old_rows.get(document_name, [])
+                chunks = [old_chunks[row] for row in rows]
+                if document_name in old_metadata:
+                    self.metadata[document_name] = old_metadata[document_name]
+                vector_parts.append(old_vectors[rows] if rows else None)
+                if reusable and rows and document_name in self.index.names:
+                    reuse[document_name] = self.index.shard(document_name)
+            
+            all_chunks.extend(chunks)
+        
+        if not all_chunks:
+            logger.error("No chunks left to index after update")
+            return
+        
+        self.chunks = all_chunks
+        logger.info(f"Total chunks after update: {len(all_chunks)} ({len(new_chunks)} newly embedded)")
+        
+        # Build FAISS shards for new and changed guidelines, and the BM25 index from the chunks
+        self.build_faiss_index(np.vstack([part for part in vector_parts if part is not None]), reuse)
+        self.build_lexical_index()
+        
+        # Save everything
+        self.save_processed_data()
+    
+    def _stored_vectors(self) -> np.ndarray:
+        """
+        Vectors of the loaded chunks in row order: the exact sidecar when it
+        matches, otherwise reconstructed from the index
+        """
+        if self.embeddings is not None and len(self.embeddings) == len(self.chunks):
+            return np.asarray(self.embeddings)
+        
+        logger.info("No vector sidecar found, reconstructing vectors from the FAISS index")
+        return reconstruct_all(self.index)
+    
+    def report_index_options(self, k: int = 10) -> List[Dict]:
+        """
+        Benchmark every index spec on the current vectors against exact search,
+        sharded per guideline as served, and save the recall@k / memory /
+        latency report next to the index
+        """
+        logger.info("Benchmarking FAISS index options...")
+        
+        report = benchmark_index_specs(self._stored_vectors(), k=k, ranges=self._document_ranges())
+        
+        with open(self.index_report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        
+        logger.info("FAISS index options:\n" + format_index_report(report))
+        return report
+    
+    def _list_pdf_files(self) -> List[str]:
+        """
+        PDF files in the guidelines directory, sorted so serial, parallel and
+        incremental runs produce identically ordered output
+        """
+        return sorted(f for f in os.listdir(self.guidelines_dir) if f.endswith('.pdf'))
+    
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        """
+        SHA-256 of a file's contents
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def _chunking_signature(self) -> str:
+        """
+        Identifies the chunker version and settings that produced a document's chunks
+        """
+        return f"v{CHUNKER_VERSION}:{self.chunk_tokens}:{self.chunk_overlap_tokens}"
+    
+    def _record_document(self, pdf_file: str, document_name: str, total_pages: int,
+                         chunks: List[Dict], sha256: str):
+        """
+        Store metadata and manifest entries for a freshly processed document
+        """
+        # Recorded even when empty so an unreadable PDF is not retried on every build
+        self.manifest[pdf_file] = {
+            'sha256': sha256,
+            'chunking': self._chunking_signature(),
+            'document_name': document_name,
+            'total_chunks': len(chunks)
+        }
+        
+        if not total_pages:
+            logger.warning(f"No text extracted from {pdf_file}")
+            return
+        
+        # Store metadata
+        self.metadata[document_name] = {
+            'filename': pdf_file,
+            'total_pages': total_pages,
+            'total_chunks': len(chunks),
+            'processed_date': datetime.now().isoformat()
+        }
+    
+    def _ingest(self, pdf_files: List[str]) -> List[Tuple[str, str, int, List[Dict]]]:
+        """
+        Extract and chunk the given PDFs, in parallel when workers > 1
+        """
+        if self.workers > 1:
+            return self._ingest_parallel(pdf_files)
+        return self._ingest_serial(pdf_files)
+    
+    def _ingest_serial(self, pdf_files: List[str]) -> List[Tuple[str, str, int, List[Dict]]]:
+        """
+        Extract and chunk PDFs one at a time in this process
+        """
+        documents = []
         
         for pdf_file in pdf_files:
             pdf_path = os.path.join(self.guidelines_dir, pdf_file)
@@ -218,33 +519,65 @@ class ESCGuidelinesProcessor:
             # Extract text from PDF
             pages_data = self.extract_text_from_pdf(pdf_path)
             
-            if not pages_data:
-                logger.warning(f"No text extracted from {pdf_file}")
-                continue
-            
             # Chunk the text
-            chunks = self.chunk_text(pages_data, document_name)
-            all_chunks.extend(chunks)
-            
-            # Store metadata
-            self.metadata[document_name] = {
-                'filename': pdf_file,
-                'total_pages': len(pages_data),
-                'total_chunks': len(chunks),
-                'processed_date': datetime.now().isoformat()
-            }
-        
-        self.chunks = all_chunks
-        logger.info(f"Total chunks created: {len(all_chunks)}")
-        
-        # Generate embeddings
-        embeddings = self.generate_embeddings(all_chunks)
+            chunks = self.chunk_text(pages_data, document_name, self.chunk_tokens,
+                                     self.chunk_overlap_tokens) if pages_data else []
+            documents.append((pdf_file, document_name, len(pages_data), chunks))
         
-        # Build FAISS index
-        self.build_faiss_index(embeddings)
+        return documents
+    
+    def _ingest_parallel(self, pdf_files: List[str]) -> List[Tuple[str, str, int, List[Dict]]]:
+        """
+        Extract and chunk PDFs on a process pool. Large PDFs are split into
+        page ranges of `pages_per_task` pages; results are reassembled in
+        input order so the output matches a serial run.
+        """
+        logger.info(f"Ingesting {len(pdf_files)} PDFs with {self.workers} worker processes")
+        
+        # Spawn rather than fork: the parent already holds a loaded torch model
+        mp_context = multiprocessing.get_context('spawn')
+        documents = []
+        
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=mp_context) as pool:
+            # Submit every page range of every PDF up front so all workers stay busy
+            extract_jobs = []
+            for pdf_file in pdf_files:
+                pdf_path = os.path.join(self.guidelines_dir, pdf_file)
+                document_name = os.path.splitext(pdf_file)[0]
+                
+                try:
+                    with fitz.open(pdf_path) as doc:
+                        page_count = len(doc)
+                except Exception as e:
+                    logger.error(f"Error extracting text from {pdf_path}: {str(e)}")
+                    extract_jobs.append((pdf_file, document_name, []))
+                    continue
+                
+                futures = [
+                    pool.submit(extract_page_range, pdf_path, start, min(start + self.pages_per_task, page_count))
+                    for start in range(0, page_count, self.pages_per_task)
+                ]
+                extract_jobs.append((pdf_file, document_name, futures))
+            
+            # Chunk each document as soon as all of its page ranges are back
+            chunk_jobs = []
+            for pdf_file, document_name, futures in extract_jobs:
+                try:
+                    pages_data = [page for future in futures for page in future.result()]
+                except Exception as e:
+                    logger.error(f"Error extracting text from {pdf_file}: {str(e)}")
+                    pages_data = []
+                
+                logger.info(f"Extracted {len(pages_data)} pages from {pdf_file}")
+                chunk_future = pool.submit(chunk_text, pages_data, document_name, self.chunk_tokens,
+                                           self.chunk_overlap_tokens) if pages_data else None
+                chunk_jobs.append((pdf_file, document_name, len(pages_data), chunk_future))
+            
+            for pdf_file, document_name, total_pages, chunk_future in chunk_jobs:
+                chunks = chunk_future.result() if chunk_future else []
+                documents.append((pdf_file, document_name, total_pages, chunks))
         
-        # Save everything
-        self.save_processed_data()
+        return documents
     
     def save_processed_data(self):
         """
@@ -256,16 +589,99 @@ class ESCGuidelinesProcessor:
         with open(self.chunks_file, 'w', encoding='utf-8') as f:
             json.dump(self.chunks, f, indent=2, ensure_ascii=False)
         
-        # Save metadata
+        # Binary copy of the chunks that the search system memory-maps
+        write_chunk_store(self.chunk_store_file, self.chunks)
+        
+        # Save FAISS shards, their description and the exact vectors they were built from
+        if self.index:
+            self._save_shards()
+            
+            with open(self.index_info_file, 'w', encoding='utf-8') as f:
+                json.dump(self.index_info, f, indent=2)
+        
+        # Save metadata after the shards it points to
         with open(self.metadata_file, 'w', encoding='utf-8') as f:
             json.dump(self.metadata, f, indent=2, ensure_ascii=False)
         
-        # Save FAISS index
-        if self.index:
-            faiss.write_index(self.index, self.index_file)
+        # Replaced atomically: running servers memory-map this file, and rewriting it
+        # in place would change (or, if it shrinks, unmap) the vectors of their snapshot
+        if self.embeddings is not None:
+            with open(self.vectors_file + ".tmp", 'wb') as f:
+                np.save(f, self.embeddings)
+            os.replace(self.vectors_file + ".tmp", self.vectors_file)
+        
+        # BM25 index for lexical search
+        if self.lexical_index is not None:
+            self.lexical_index.save(self.lexical_index_file)
+        
+        # Nearest neighbors of every chunk; a table left from an earlier build would not match the new rows
+        if self.embeddings is not None and self.neighbor_table_size:
+            self._save_neighbor_table(self.embeddings)
+        elif os.path.exists(self.neighbors_file):
+            os.remove(self.neighbors_file)
+        
+        # Save manifest after the data so an interrupted save forces a re-index next time
+        with open(self.manifest_file, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, indent=2, ensure_ascii=False)
+        
+        # Publish the new build to running servers
+        self._write_version()
         
         logger.info("All data saved successfully!")
     
+    def _save_neighbor_table(self, vectors: np.ndarray):
+        """
+        Compute the exact top-N similar chunks of every chunk and save them,
+        so the search system answers "more like this" without the model or index
+        """
+        started = time.perf_counter()
+        scores, rows = nearest_neighbors(vectors, self.neighbor_table_size)
+        save_neighbor_table(self.neighbors_file, scores, rows)
+        logger.info(f"Neighbor table saved: {rows.shape[1]} neighbors for {len(rows)} chunks "
+                    f"in {time.perf_counter() - started:.1f}s")
+    
+    def _write_version(self):
+        """
+        Atomically write version.json with a new build id. It is written
+        after all other files, so a server that sees a new id can reload a
+        complete snapshot.
+        """
+        version = {
+            'version': uuid.uuid4().hex[:16],
+            'created': datetime.now().isoformat(),
+            'total_chunks': len(self.chunks)
+        }
+        
+        with open(self.version_file + ".tmp", 'w', encoding='utf-8') as f:
+            json.dump(version, f, indent=2)
+        os.replace(self.version_file + ".tmp", self.version_file)
+        
+        logger.info(f"Published processed data version {version['version']}")
+    
+    def _save_shards(self):
+        """
+        Write rebuilt shards (each replaced atomically), remove shards of
+        removed guidelines and the single-file index of older builds
+        """
+        os.makedirs(self.shard_dir, exist_ok=True)
+        
+        current = set()
+        for document_name, index in zip(self.index.names, self.index.shards):
+            path = os.path.join(self.output_dir, shard_file(document_name))
+            current.add(os.path.basename(path))
+            if document_name in self.built_shards or not os.path.exists(path):
+                faiss.write_index(index, path + ".tmp")
+                os.replace(path + ".tmp", path)
+        
+        for filename in os.listdir(self.shard_dir):
+            if filename not in current:
+                os.remove(os.path.join(self.shard_dir, filename))
+        
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+        
+        logger.info(f"Saved {len(self.built_shards)} of {len(self.index)} FAISS shards")
+    
     def load_processed_data(self):
         """
         Load previously processed data
@@ -282,10 +698,23 @@ class ESCGuidelinesProcessor:
             with open(self.metadata_file, 'r', encoding='utf-8') as f:
                 self.metadata = json.load(f)
         
-        # Load FAISS index
-        if os.path.exists(self.index_file):
+        # Load manifest
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        
+        # Load FAISS shards listed in the metadata, or the single index of older builds
+        self.index = load_sharded_index(self.output_dir, self.metadata, mmap=False)
+        if self.index is None and os.path.exists(self.index_file):
             self.index = faiss.read_index(self.index_file)
         
+        if os.path.exists(self.index_info_file):
+            with open(self.index_info_file, 'r', encoding='utf-8') as f:
+                self.index_info = json.load(f)
+        
+        if os.path.exists(self.vectors_file):
+            self.embeddings = np.load(self.vectors_file, mmap_mode='r')
+        
         logger.info(f"Loaded {len(self.chunks)} chunks and index with {self.index.ntotal if self.index else 0} vectors")
     
     def search(self, query: str, top_k: int = 10) -> List[Dict]:
@@ -297,14 +726,14 @@ class ESCGuidelinesProcessor:
             return []
         
         # Generate query embedding
-        query_embedding = self.embedding_model.encode([query])
+        query_embedding = normalize(self.embedding_model.encode([query]))
         
         # Search in FAISS index
-        scores, indices = self.index.search(query_embedding.astype('float32'), top_k)
+        scores, indices = self.index.search(query_embedding, top_k)
         
         results = []
         for i, (score, idx) in enumerate(zip(scores[0], indices[0])):
-            if idx < len(self.chunks):
+            if 0 <= idx < len(self.chunks):
                 chunk = self.chunks[idx].copy()
                 chunk['similarity_score'] = float(score)
                 chunk['rank'] = i + 1
@@ -316,15 +745,15 @@ def main():
     """
     Main function to run the processing
     """
-    processor = ESCGuidelinesProcessor()
+    workers = int(os.environ.get('INGEST_WORKERS', DEFAULT_INGEST_WORKERS))
+    cache_mb = int(os.environ.get('EMBEDDING_CACHE_MB', DEFAULT_CACHE_MAX_BYTES // (1024 * 1024)))
+    index_spec = os.environ.get('INDEX_SPEC', DEFAULT_INDEX_SPEC)
+    neighbors = int(os.environ.get('NEIGHBOR_TABLE_SIZE', NEIGHBOR_TABLE_SIZE))
+    processor = ESCGuidelinesProcessor(workers=workers, embedding_cache_bytes=cache_mb * 1024 * 1024,
+                                       index_spec=index_spec, neighbor_table_size=neighbors)
     
-    # Check if processed data exists
-    if os.path.exists(processor.chunks_file) and os.path.exists(processor.index_file):
-        logger.info("Found existing processed data. Loading...")
-        processor.load_processed_data()
-    else:
-        logger.info("No existing processed data found. Processing guidelines...")
-        processor.process_all_guidelines()
+    # Re-index only new or changed guidelines (full processing on first run)
+    processor.update_guidelines()
     
     # Print summary
     print("\n" + "="*60)
@@ -337,6 +766,13 @@ def main():
     for doc_name, meta in processor.metadata.items():
         print(f"  - {doc_name}: {meta['total_pages']} pages, {meta['total_chunks']} chunks")
     
+    # Compare index options against exact search when requested (e.g. by build.py)
+    if os.environ.get('INDEX_REPORT') == '1' and processor.index:
+        print("\n" + "="*60)
+        print("FAISS INDEX OPTIONS (recall@k vs exact search)")
+        print("="*60)
+        print(format_index_report(processor.report_index_options()))
+    
     # Test search functionality
     print("\n" + "="*60)
     print("TESTING SEARCH FUNCTIONALITY")
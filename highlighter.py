@@ -0,0 +1,108 @@
+"""
+Query term highlighting for ESC Guidelines search results
+One compiled pattern per query; matches are reported as offsets and shown in a short snippet instead of the full chunk
+"""
+
+import re
+from typing import Dict, List, Optional, Tuple
+from lexical_index import tokenize
+
+# Characters of chunk text shown around the best cluster of matches
+SNIPPET_LENGTH = 400
+
+# Query terms shorter than this are not highlighted
+MIN_TERM_LENGTH = 3
+
+# Marker wrapped around highlighted terms in highlighted_text
+HIGHLIGHT_MARKER = '**'
+
+def mark(text: str, spans: List[Tuple[int, int]], marker: str = HIGHLIGHT_MARKER) -> str:
+    """Wrap each (start, end) span of text in markers, keeping the original text otherwise"""
+    parts = []
+    position = 0
+    for start, end in spans:
+        parts.append(text[position:start])
+        parts.append(marker + text[start:end] + marker)
+        position = end
+    parts.append(text[position:])
+    return ''.join(parts)
+
+class QueryHighlighter:
+    """
+    Finds the terms of one query in result texts.
+
+    All terms are compiled into a single case-insensitive alternation,
+    longest first, anchored at word starts so a term also matches its
+    inflections ("blocker" in "blockers") but not the middle of other words.
+    Build it once per query and reuse it for every returned result.
+    """
+    
+    def __init__(self, query: str, min_term_length: int = MIN_TERM_LENGTH):
+        terms = sorted({term for term in tokenize(query) if len(term) >= min_term_length},
+                       key=lambda term: (-len(term), term))
+        self.pattern: Optional[re.Pattern] = (
+            re.compile(r'\b(?:' + '|'.join(map(re.escape, terms)) + r')\w*', re.IGNORECASE) if terms else None
+        )
+    
+    def offsets(self, text: str) -> List[Tuple[int, int]]:
+        """(start, end) character offsets of every match, in order"""
+        if self.pattern is None:
+            return []
+        return [match.span() for match in self.pattern.finditer(text)]
+    
+    def highlight(self, text: str) -> str:
+        """The whole text with matches marked"""
+        return mark(text, self.offsets(text))
+    
+    def snippet(self, text: str, length: int = SNIPPET_LENGTH,
+                spans: Optional[List[Tuple[int, int]]] = None) -> Dict:
+        """
+        A window of about `length` characters around the densest cluster of
+        matches, cut at word boundaries. Returns the snippet text, its start
+        and end offsets in the chunk, and the match offsets relative to the
+        snippet. Pass `spans` when the offsets are already known.
+        """
+        if spans is None:
+            spans = self.offsets(text)
+        start, end = 0, len(text)
+        
+        if len(text) > length:
+            first, last = 0, 0
+            if spans:
+                # Most matches that fit in one window (two pointers over the sorted spans)
+                best = 0
+                i = 0
+                for j in range(len(spans)):
+                    while spans[j][1] - spans[i][0] > length:
+                        i += 1
+                    if j - i + 1 > best:
+                        best, first, last = j - i + 1, i, j
+                
+                padding = (length - (spans[last][1] - spans[first][0])) // 2
+                start = max(0, spans[first][0] - padding)
+            end = min(len(text), start + length)
+            start = max(0, end - length)
+            
+            # Do not cut words in half, but never drop a match from the window
+            if start > 0:
+                space = text.find(' ', start, spans[first][0] if spans else end)
+                if space != -1:
+                    start = space + 1
+            if end < len(text):
+                space = text.rfind(' ', spans[last][1] if spans else start, end)
+                if space != -1:
+                    end = space
+        
+        return {
+            'text': text[start:end],
+            'start': start,
+            'end': end,
+            'highlights': [(s - start, e - start) for s, e in spans if s >= start and e <= end]
+        }
+    
+    def highlighted_snippet(self, text: str, length: int = SNIPPET_LENGTH,
+                            spans: Optional[List[Tuple[int, int]]] = None) -> str:
+        """Snippet with matches marked and ellipses where the chunk text was cut"""
+        snippet = self.snippet(text, length, spans)
+        return (('...' if snippet['start'] > 0 else '') + mark(snippet['text'], snippet['highlights']) +
+                ('...' if snippet['end'] < len(text) else ''))
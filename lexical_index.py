@@ -0,0 +1,149 @@
+"""
+BM25 inverted index for lexical search over ESC Guidelines chunks
+Built once at processing time and saved next to the FAISS index
+"""
+
+import os
+import re
+import math
+import logging
+from collections import Counter
+from typing import List, Tuple, Optional
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+# BM25 term-frequency saturation and length normalization
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Lowercased word characters; keeps abbreviations and numbers such as "lvef" and "40"
+WORD_PATTERN = re.compile(r"\w+")
+
+# Frequent words that carry no meaning for guideline search and only make postings long
+STOPWORDS = frozenset("""
+a an and are as at be by for from has have how in is it of on or should that the their this to
+was were what when which who with
+""".split())
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase word tokens without stopwords, shared by indexing and querying
+    """
+    return [token for token in WORD_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+class BM25Index:
+    """
+    Inverted index with precomputed BM25 weights.
+
+    Postings of all terms are stored back to back: term i owns
+    doc_ids[term_offsets[i]:term_offsets[i + 1]] and the matching weights,
+    so a query only touches the postings of its own terms.
+    """
+    
+    def __init__(self, terms: List[str], term_offsets: np.ndarray, doc_ids: np.ndarray,
+                 weights: np.ndarray, num_docs: int):
+        self.terms = terms
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.num_docs = num_docs
+        self.vocabulary = {term: i for i, term in enumerate(terms)}
+    
+    @classmethod
+    def build(cls, texts: List[str], k1: float = BM25_K1, b: float = BM25_B) -> 'BM25Index':
+        """
+        Tokenize texts and build postings lists with BM25 weights
+        """
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+        postings = {}
+        
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths[doc_id] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((doc_id, tf))
+        
+        average_length = float(doc_lengths.mean()) if len(texts) and doc_lengths.any() else 1.0
+        length_norm = k1 * (1 - b + b * doc_lengths / average_length)
+        
+        terms = sorted(postings)
+        term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        doc_ids = []
+        weights = []
+        
+        for i, term in enumerate(terms):
+            docs, tfs = zip(*postings[term])
+            docs = np.array(docs, dtype=np.uint32)
+            tfs = np.array(tfs, dtype=np.float32)
+            idf = math.log(1 + (len(texts) - len(docs) + 0.5) / (len(docs) + 0.5))
+            
+            doc_ids.append(docs)
+            weights.append(idf * tfs * (k1 + 1) / (tfs + length_norm[docs]))
+            term_offsets[i + 1] = term_offsets[i] + len(docs)
+        
+        index = cls(terms, term_offsets,
+                    np.concatenate(doc_ids) if doc_ids else np.zeros(0, dtype=np.uint32),
+                    np.concatenate(weights).astype(np.float32) if weights else np.zeros(0, dtype=np.float32),
+                    len(texts))
+        
+        logger.info(f"BM25 index built: {len(terms)} terms, {len(index.doc_ids)} postings")
+        return index
+    
+    def save(self, path: str):
+        """
+        Save the index as an uncompressed .npz file, replacing `path` atomically
+        """
+        with open(path + ".tmp", 'wb') as f:
+            np.savez(f, version=FORMAT_VERSION, num_docs=self.num_docs,
+                     terms=np.array(self.terms, dtype=str), term_offsets=self.term_offsets,
+                     doc_ids=self.doc_ids, weights=self.weights)
+        os.replace(path + ".tmp", path)
+    
+    @classmethod
+    def load(cls, path: str) -> 'BM25Index':
+        """
+        Load an index written by save()
+        """
+        with np.load(path) as data:
+            if int(data['version']) != FORMAT_VERSION:
+                raise ValueError(f"Unsupported BM25 index version {int(data['version'])} in {path}")
+            
+            return cls(data['terms'].tolist(), data['term_offsets'], data['doc_ids'],
+                       data['weights'], int(data['num_docs']))
+    
+    def search(self, query: str, top_k: int = 10, allowed: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, BM25 score) pairs for a query, best first. `allowed` is
+        an optional boolean mask over rows; other rows are never ranked.
+        """
+        term_ids = [self.vocabulary[term] for term in dict.fromkeys(tokenize(query)) if term in self.vocabulary]
+        if not term_ids or top_k <= 0:
+            return []
+        
+        # Accumulate the precomputed weights of the query terms' postings
+        docs = np.concatenate([self.doc_ids[self.term_offsets[t]:self.term_offsets[t + 1]] for t in term_ids])
+        weights = np.concatenate([self.weights[self.term_offsets[t]:self.term_offsets[t + 1]] for t in term_ids])
+        candidates, positions = np.unique(docs, return_inverse=True)
+        scores = np.bincount(positions, weights=weights)
+        
+        if allowed is not None:
+            keep = allowed[candidates]
+            candidates = candidates[keep]
+            scores = scores[keep]
+            if not len(candidates):
+                return []
+        
+        # Partial sort: only the top_k candidates are ordered
+        if len(candidates) > top_k:
+            best = np.argpartition(-scores, top_k - 1)[:top_k]
+        else:
+            best = np.arange(len(candidates))
+        best = best[np.argsort(-scores[best], kind='stable')]
+        
+        return [(int(candidates[i]), float(scores[i])) for i in best]
+    
+    def __len__(self) -> int:
+        return self.num_docs
@@ -0,0 +1,249 @@
+"""
+PDF text extraction and chunking for ESC Guidelines processing
+Kept free of torch and the embedding model so process pool workers start quickly and stay small
+"""
+
+import re
+import logging
+from typing import List, Dict, Optional, Iterator
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# Chunk size targets in (approximate) model tokens. all-MiniLM-L6-v2 truncates input at 256
+# word pieces, and the estimate below counts fewer tokens than the tokenizer, so aim lower
+CHUNK_TOKENS = 200
+CHUNK_OVERLAP_TOKENS = 32
+
+# Approximates word-piece tokenization without loading the model tokenizer
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+# Dot leaders ("Introduction ........ 12"), also spaced or as ellipsis characters
+LEADER_PATTERN = re.compile(r'(?:\.\s?){4,}|\u2026{2,}')
+
+def extract_page_range(pdf_path: str, page_start: int = 0, page_end: Optional[int] = None) -> List[Dict]:
+    """
+    Extract cleaned text for pages [page_start, page_end) of a PDF.
+    Module-level so it can run inside a process pool worker.
+    """
+    pages_data = []
+    
+    # Use PyMuPDF for fast text extraction with coordinates
+    doc = fitz.open(pdf_path)
+    try:
+        if page_end is None:
+            page_end = len(doc)
+        
+        for page_num in range(page_start, page_end):
+            # Block structure keeps paragraph boundaries and font information for headings
+            blocks = extract_page_blocks(doc[page_num])
+            text = ' '.join(block['text'] for block in blocks)
+            
+            if text.strip():  # Only add non-empty pages
+                pages_data.append({
+                    'page_number': page_num + 1,
+                    'text': text,
+                    'blocks': blocks,
+                    'char_count': len(text),
+                    'word_count': len(text.split())
+                })
+    finally:
+        doc.close()
+    
+    return pages_data
+
+def extract_page_blocks(page) -> List[Dict]:
+    """
+    Cleaned text blocks of a PyMuPDF page, each flagged as heading or body text
+    """
+    text_blocks = [block for block in page.get_text('dict')['blocks'] if block.get('type') == 0]
+    
+    # Body font size is the size carrying the most characters on the page
+    size_chars = {}
+    for block in text_blocks:
+        for line in block['lines']:
+            for span in line['spans']:
+                size = round(span['size'], 1)
+                size_chars[size] = size_chars.get(size, 0) + len(span['text'].strip())
+    body_size = max(size_chars, key=size_chars.get) if size_chars else 0
+    page_height = page.rect.height
+    
+    blocks = []
+    for block in text_blocks:
+        spans = [span for line in block['lines'] for span in line['spans'] if span['text'].strip()]
+        raw_text = '\n'.join(''.join(span['text'] for span in line['spans']) for line in block['lines'])
+        text = clean_text(raw_text)
+        
+        if spans and text:
+            # Running headers and footers sit in the top and bottom margins
+            top, bottom = block['bbox'][1], block['bbox'][3]
+            in_margin = bottom < page_height * 0.07 or top > page_height * 0.93
+            
+            blocks.append({
+                'text': text,
+                'heading': not in_margin and is_heading(text, raw_text, spans, body_size)
+            })
+    
+    return blocks
+
+def clean_text(text: str) -> str:
+    """
+    Clean extracted text
+    """
+    # Remove dot leaders of tables of contents; one run costs ~100 estimated tokens
+    text = LEADER_PATTERN.sub(' ', text)
+    
+    # Remove excessive whitespace
+    text = re.sub(r'\s+', ' ', text)
+    
+    # Remove page headers/footers patterns (common in medical guidelines)
+    text = re.sub(r'Page \d+ of \d+', '', text)
+    text = re.sub(r'ESC Guidelines.*?\d{4}', '', text)
+    
+    # Remove URLs and DOIs
+    text = re.sub(r'https?://[^\s]+', '', text)
+    text = re.sub(r'doi:\s*[^\s]+', '', text)
+    
+    return text.strip()
+
+def chunk_text(pages_data: List[Dict], document_name: str,
+               chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Dict]:
+    """
+    Chunk text into searchable segments with overlap
+    """
+    logger.info(f"Chunking text for {document_name}")
+    
+    chunks = list(iter_chunks(pages_data, document_name, chunk_tokens, overlap_tokens))
+    
+    logger.info(f"Created {len(chunks)} chunks for {document_name}")
+    return chunks
+
+def iter_chunks(pages_data: List[Dict], document_name: str,
+                chunk_tokens: int = CHUNK_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[Dict]:
+    """
+    Stream chunks of at most `chunk_tokens` tokens across page boundaries.
+    A heading starts a new chunk once the current one is a quarter full, so
+    chunks rarely straddle sections; chunks cut for size carry the last
+    `overlap_tokens` tokens into the next one. Words too long to fit next to
+    the overlap are split.
+    """
+    words, pages, costs = [], [], []  # buffered words with their page and token cost
+    tokens = 0
+    fresh = 0  # words added since the last chunk was emitted
+    section_title = "General"
+    chunk_section = section_title
+    chunk_numbers = {}  # page -> number of chunks starting on it
+    
+    for page_data in pages_data:
+        page_num = page_data['page_number']
+        blocks = page_data.get('blocks') or [{'text': page_data['text'], 'heading': False}]
+        
+        for block in blocks:
+            if block['heading']:
+                if fresh and tokens >= chunk_tokens // 4:
+                    yield make_chunk(words, pages, chunk_section, document_name, chunk_numbers)
+                    fresh = 0
+                if not fresh:
+                    # Do not carry overlap from the previous section into a new one
+                    words, pages, costs = [], [], []
+                    tokens = 0
+                section_title = block['text']
+            
+            for word in (piece for text in block['text'].split()
+                         for piece in split_word(text, chunk_tokens - overlap_tokens)):
+                cost = len(TOKEN_PATTERN.findall(word)) or 1
+                
+                # Cut before the word that would overflow the chunk
+                if fresh and tokens + cost > chunk_tokens:
+                    yield make_chunk(words, pages, chunk_section, document_name, chunk_numbers)
+                    fresh = 0
+                    
+                    # Keep the tail of this chunk as overlap for the next one
+                    keep = 0
+                    kept_tokens = 0
+                    while keep < len(words) - 1 and kept_tokens + costs[-1 - keep] <= overlap_tokens:
+                        kept_tokens += costs[-1 - keep]
+                        keep += 1
+                    
+                    start = len(words) - keep
+                    words, pages, costs = words[start:], pages[start:], costs[start:]
+                    tokens = kept_tokens
+                
+                if not fresh:
+                    chunk_section = section_title
+                
+                words.append(word)
+                pages.append(page_num)
+                costs.append(cost)
+                tokens += cost
+                fresh += 1
+    
+    if fresh:
+        yield make_chunk(words, pages, chunk_section, document_name, chunk_numbers)
+
+def split_word(word: str, max_tokens: int) -> List[str]:
+    """
+    A word as pieces of at most `max_tokens` estimated tokens (e.g. long
+    chemical names, sequences or leftover table rules without spaces)
+    """
+    tokens = TOKEN_PATTERN.findall(word)
+    if len(tokens) <= max_tokens:
+        return [word]
+    return [''.join(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max(1, max_tokens))]
+
+def make_chunk(words: List[str], pages: List[int], section_title: str,
+               document_name: str, chunk_numbers: Dict[int, int]) -> Dict:
+    """
+    Build a chunk record from buffered words; ids stay unique per start page
+    """
+    page_num = pages[0]
+    chunk_id = chunk_numbers.get(page_num, 0)
+    chunk_numbers[page_num] = chunk_id + 1
+    text = ' '.join(words)
+    
+    return {
+        'chunk_id': f"{document_name}_page{page_num}_chunk{chunk_id}",
+        'document_name': document_name,
+        'page_number': page_num,
+        'page_end': pages[-1],
+        'chunk_number': chunk_id,
+        'text': text,
+        'section_title': section_title,
+        'word_count': len(words),
+        'char_count': len(text)
+    }
+
+def is_heading(text: str, raw_text: str, spans: List[Dict], body_size: float) -> bool:
+    """
+    Heuristic heading test for a PyMuPDF text block: short, readable and
+    either a numbered/capitalized title or set larger or bold than body text
+    """
+    words = text.split()
+    if not 2 <= len(words) <= 20 or text.endswith(('.', ',', ';', ':')):
+        return False
+    
+    # Figures often extract as runs of control characters in large fonts
+    letters = sum(c.isalpha() for c in text)
+    if not text.isprintable() or letters < 0.6 * len(text.replace(' ', '')) or not text[0].isupper() and not text[0].isdigit():
+        return False
+    
+    if extract_section_title(raw_text) != "General":
+        return True
+    
+    # Bold table headers are set smaller than body text, bold headings are not
+    size = max(span['size'] for span in spans)
+    bold = all(span['flags'] & 16 for span in spans)
+    return size >= body_size * 1.2 or (bold and size >= body_size)
+
+def extract_section_title(text: str) -> str:
+    """
+    Try to extract section title from chunk text
+    """
+    lines = text.split('\n')
+    for line in lines[:3]:  # Check first 3 lines
+        line = line.strip()
+        # Look for numbered sections or capitalized headers
+        if re.match(r'^\d+\.?\s+[A-Z][^.]*$', line) or \
+           re.match(r'^[A-Z][A-Z\s]{10,}$', line):
+            return line
+    return "General"
@@ -0,0 +1,219 @@
+"""
+Response cache for the ESC Guidelines search API
+Serialized JSON responses keyed on the request and tagged with the index version
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the in-process cache
+DEFAULT_RESULT_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_RESULT_CACHE_TTL = 3600
+
+# Size cap of the shared SQLite store and how often a writing process prunes it
+DEFAULT_RESULT_DB_BYTES = 256 * 1024 * 1024
+RESULT_DB_PRUNE_SECONDS = 60
+
+class SQLiteResultBackend:
+    """
+    Shared second-level store in a SQLite file, so every gunicorn worker
+    (and restarts) can reuse responses computed by another process.
+    Writers prune it every RESULT_DB_PRUNE_SECONDS: expired rows go first,
+    then the rows closest to expiry until the payloads fit in max_bytes.
+    Rows of older index versions are never read again and leave the same way.
+    """
+    
+    def __init__(self, path: str, max_bytes: int = DEFAULT_RESULT_DB_BYTES,
+                 prune_seconds: float = RESULT_DB_PRUNE_SECONDS):
+        self.path = path
+        self.max_bytes = max(0, max_bytes)
+        self.prune_seconds = prune_seconds
+        self._local = threading.local()
+        self._last_prune = 0.0
+        self._prune_lock = threading.Lock()
+        
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    expires REAL NOT NULL,
+                    payload BLOB NOT NULL
+                )
+            """)
+    
+    def _connect(self) -> sqlite3.Connection:
+        """One connection per thread; SQLite connections are not shared across threads"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            self._local.connection = connection
+        return connection
+    
+    def get(self, key: str) -> Optional[Tuple[float, bytes]]:
+        row = self._connect().execute("SELECT expires, payload FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None or row[0] < time.time():
+            return None
+        return row[0], bytes(row[1])
+    
+    def set(self, key: str, expires: float, payload: bytes):
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO results (key, expires, payload) VALUES (?, ?, ?)",
+                               (key, expires, payload))
+        
+        # One writer per interval and process does the pruning
+        now = time.time()
+        if now - self._last_prune >= self.prune_seconds and self._prune_lock.acquire(blocking=False):
+            try:
+                self._last_prune = now
+                self.prune()
+            finally:
+                self._prune_lock.release()
+    
+    def prune(self):
+        """Delete expired rows, then the rows expiring soonest beyond the size cap"""
+        with self._connect() as connection:
+            connection.execute("DELETE FROM results WHERE expires < ?", (time.time(),))
+            connection.execute("""
+                DELETE FROM results WHERE expires <= (
+                    SELECT expires FROM (
+                        SELECT expires, SUM(length(payload)) OVER (ORDER BY expires DESC, key) AS total
+                        FROM results
+                    ) WHERE total > ? ORDER BY expires DESC LIMIT 1
+                )
+            """, (self.max_bytes,))
+
+class ResultCache:
+    """
+    LRU cache of serialized responses with a TTL and a size cap in bytes.
+
+    Keys include the index version, so rebuilding processed_guidelines/
+    makes old entries unreachable; they age out through LRU eviction.
+    An optional backend is consulted on local misses and written through.
+    """
+    
+    def __init__(self, max_bytes: int = DEFAULT_RESULT_CACHE_BYTES, ttl: float = DEFAULT_RESULT_CACHE_TTL,
+                 backend: Optional[SQLiteResultBackend] = None):
+        self.max_bytes = max(0, max_bytes)
+        self.ttl = ttl
+        self.backend = backend
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        # key -> (expires, payload)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(index_version: str, endpoint: str, **params) -> str:
+        """Stable key for a request; parameters are serialized with sorted names"""
+        raw = json.dumps([index_version, endpoint, params], sort_keys=True, ensure_ascii=False)
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def get(self, key: str) -> Optional[bytes]:
+        """Cached payload, or None if missing or expired"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._remove(key)
+        
+        if self.backend:
+            try:
+                entry = self.backend.get(key)
+            except sqlite3.Error as e:
+                logger.warning(f"Result cache backend read failed: {e}")
+                entry = None
+            if entry is not None:
+                self._store(key, *entry)
+                with self._lock:
+                    self.hits += 1
+                return entry[1]
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def set(self, key: str, payload: bytes):
+        """Cache a payload for the configured TTL"""
+        expires = time.time() + self.ttl
+        self._store(key, expires, payload)
+        
+        if self.backend:
+            try:
+                self.backend.set(key, expires, payload)
+            except sqlite3.Error as e:
+                logger.warning(f"Result cache backend write failed: {e}")
+    
+    def _store(self, key: str, expires: float, payload: bytes):
+        """Insert into the local LRU and evict down to the size cap"""
+        if len(payload) > self.max_bytes:
+            return
+        
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires, payload)
+            self.size += len(payload)
+            
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+    
+    def _remove(self, key: str):
+        _, payload = self._entries.pop(key)
+        self.size -= len(payload)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+    
+    def stats(self) -> Dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'shared_backend': self.backend.path if self.backend else None
+            }
+
+def result_cache_from_env() -> Optional[ResultCache]:
+    """
+    Build the response cache from RESULT_CACHE_MB, RESULT_CACHE_TTL,
+    RESULT_CACHE_DB and RESULT_CACHE_DB_MB; returns None when RESULT_CACHE_MB is 0
+    """
+    max_mb = float(os.environ.get('RESULT_CACHE_MB', DEFAULT_RESULT_CACHE_BYTES // (1024 * 1024)))
+    if max_mb <= 0:
+        return None
+    
+    backend = None
+    db_path = os.environ.get('RESULT_CACHE_DB')
+    if db_path:
+        db_mb = float(os.environ.get('RESULT_CACHE_DB_MB', DEFAULT_RESULT_DB_BYTES // (1024 * 1024)))
+        try:
+            backend = SQLiteResultBackend(db_path, int(db_mb * 1024 * 1024))
+            backend.prune()
+        except sqlite3.Error as e:
+            logger.warning(f"Cannot open shared result cache {db_path}, using a local cache only: {e}")
+    
+    return ResultCache(int(max_mb * 1024 * 1024),
+                       float(os.environ.get('RESULT_CACHE_TTL', DEFAULT_RESULT_CACHE_TTL)),
+                       backend)
@@ -0,0 +1,126 @@
+"""
+Medical vocabulary matching for ESC Guidelines search
+Token trie over every term and synonym, built once, so finding them in a text costs time linear in the text length
+"""
+
+import json
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+from lexical_index import WORD_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Trie key marking the end of a phrase; word tokens are never empty
+_END = ''
+
+class TermMatch(NamedTuple):
+    """A vocabulary phrase found in a text, with the concepts it names"""
+    text: str
+    concepts: Tuple[str, ...]
+    start: int
+    end: int
+
+def phrase_tokens(text: str) -> List[str]:
+    """Lowercase word tokens; 'Beta-blockers' and 'beta blockers' match alike"""
+    return WORD_PATTERN.findall(text.lower())
+
+class TermMatcher:
+    """
+    Matches vocabulary phrases on whole-word boundaries.
+
+    Each concept has a preferred term and synonyms; all of them are inserted
+    into a trie keyed by lowercase word tokens. A text is scanned once,
+    taking the longest phrase starting at each token, so "acute MI" wins over
+    "MI" and "MI" never matches inside "administration". The cost depends on
+    the length of the text and of the longest phrase, not on the vocabulary size.
+    """
+    
+    def __init__(self, vocabulary: Dict[str, List[str]]):
+        # concept -> [preferred term, synonyms...]
+        self.concepts: Dict[str, List[str]] = {}
+        self._root: Dict = {}
+        
+        for term, synonyms in vocabulary.items():
+            self.add(term, synonyms)
+    
+    def add(self, term: str, synonyms: List[str]):
+        """Add a concept, or more synonyms of an existing one"""
+        phrases = self.concepts.setdefault(term, [term])
+        for phrase in [term, *synonyms]:
+            if phrase not in phrases:
+                phrases.append(phrase)
+            
+            tokens = phrase_tokens(phrase)
+            if not tokens:
+                continue
+            
+            node = self._root
+            for token in tokens:
+                node = node.setdefault(token, {})
+            concepts = node.setdefault(_END, [])
+            if term not in concepts:
+                concepts.append(term)
+    
+    def find(self, text: str) -> List[TermMatch]:
+        """Non-overlapping phrase matches, leftmost-longest, in text order"""
+        tokens = [(match.group().lower(), match.start(), match.end()) for match in WORD_PATTERN.finditer(text)]
+        matches = []
+        
+        i = 0
+        while i < len(tokens):
+            node = self._root
+            longest = None
+            j = i
+            while j < len(tokens) and tokens[j][0] in node:
+                node = node[tokens[j][0]]
+                j += 1
+                if _END in node:
+                    longest = (j, node[_END])
+            
+            if longest is None:
+                i += 1
+                continue
+            
+            end, concepts = longest
+            start, stop = tokens[i][1], tokens[end - 1][2]
+            matches.append(TermMatch(text[start:stop], tuple(concepts), start, stop))
+            i = end
+        
+        return matches
+    
+    def concepts_in(self, text: str) -> List[str]:
+        """Preferred terms of the concepts mentioned in a text, in order of first mention"""
+        return list(dict.fromkeys(concept for match in self.find(text) for concept in match.concepts))
+    
+    def variants(self, text: str, limit: int) -> List[str]:
+        """
+        Rewrites of a text with one mentioned term replaced by another name
+        of its concept, in text and vocabulary order, at most `limit`
+        """
+        matches = self.find(text)
+        used = {tuple(phrase_tokens(match.text)) for match in matches}
+        
+        variants = []
+        for match in matches:
+            for concept in match.concepts:
+                for phrase in self.concepts[concept]:
+                    if tuple(phrase_tokens(phrase)) not in used:
+                        variants.append(text[:match.start] + phrase + text[match.end:])
+        return list(dict.fromkeys(variants))[:limit]
+    
+    def __len__(self) -> int:
+        return len(self.concepts)
+
+def load_vocabulary(path: str) -> Dict[str, List[str]]:
+    """
+    Read a vocabulary file: a JSON object mapping each preferred term to a
+    list of synonyms (MeSH-style entry terms)
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        vocabulary = json.load(f)
+    
+    if not isinstance(vocabulary, dict) or not all(isinstance(synonyms, list) for synonyms in vocabulary.values()):
+        raise ValueError(f"{path} must map each term to a list of synonyms")
+    
+    logger.info(f"Loaded {len(vocabulary)} vocabulary terms from {path}")
+    return vocabulary
@@ -0,0 +1,527 @@
+"""
+FAISS index helpers shared by the ESC Guidelines processor and search system
+Vectors are L2-normalized and searched by inner product, so scores are cosine similarities
+"""
+
+import os
+import math
+import time
+import heapq
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Sequence, Tuple
+import faiss
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Index types selectable by name; any other string is passed to faiss.index_factory
+INDEX_SPECS = ('flat', 'hnsw', 'hnsw_sq8', 'ivf_pq')
+DEFAULT_INDEX_SPEC = 'hnsw'
+
+# HNSW graph parameters
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 40
+
+# Query-time defaults for HNSW candidate list size and IVF lists probed
+DEFAULT_EF_SEARCH = 64
+DEFAULT_NPROBE = 8
+
+# Minimum training points per IVF list / PQ centroid that FAISS asks for
+MIN_POINTS_PER_CENTROID = 39
+
+# Read flags that map stored vectors/codes from the file instead of copying them
+MMAP_READ_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+
+# Per-document shards live in this subdirectory of the processed data
+SHARD_DIR = 'shards'
+
+# Format of the precomputed nearest-neighbor table
+NEIGHBOR_TABLE_VERSION = 1
+
+# Chunks scored against all others per block when building the neighbor table
+NEIGHBOR_BLOCK_SIZE = 1024
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Return a float32, C-contiguous, L2-normalized copy of the vectors
+    """
+    vectors = np.array(vectors, dtype=np.float32, order='C', ndmin=2)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def factory_string(spec: str, dimension: int, ntotal: int) -> str:
+    """
+    Translate an index spec name into a faiss.index_factory description
+    """
+    spec = spec.strip()
+    name = spec.lower()
+    
+    if name == 'flat':
+        return 'Flat'
+    if name == 'hnsw':
+        return f'HNSW{HNSW_M}'
+    if name == 'hnsw_sq8':
+        return f'HNSW{HNSW_M}_SQ8'
+    if name == 'ivf_pq':
+        # Scale lists and PQ code size down for small corpora so training has enough points
+        nlist = max(1, min(int(4 * math.sqrt(ntotal)), ntotal // MIN_POINTS_PER_CENTROID))
+        nbits = max(4, min(8, int(math.log2(max(1, ntotal // MIN_POINTS_PER_CENTROID)))))
+        subquantizers = next(m for m in (dimension // 8, dimension // 4, dimension // 2, dimension, 1)
+                             if m and dimension % m == 0)
+        return f'IVF{nlist},PQ{subquantizers}x{nbits}'
+    
+    return spec
+
+def new_index(spec: str, dimension: int, ntotal: int) -> faiss.Index:
+    """
+    Empty inner-product index of the given spec, sized for ntotal training
+    vectors; IVF specs fall back to HNSW when there are too few to train
+    """
+    description = factory_string(spec, dimension, ntotal)
+    if description.startswith('IVF') and ntotal < 2 ** 4 * MIN_POINTS_PER_CENTROID:
+        logger.warning(f"Only {ntotal} vectors, too few to train {description}; using HNSW instead")
+        description = factory_string('hnsw', dimension, ntotal)
+    
+    index = faiss.index_factory(dimension, description, faiss.METRIC_INNER_PRODUCT)
+    if hasattr(index, 'hnsw'):
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    return index
+
+def train_index(embeddings: np.ndarray, spec: str = DEFAULT_INDEX_SPEC) -> Optional[faiss.Index]:
+    """
+    Empty index of the given spec with its quantizers (IVF lists, PQ or SQ
+    codebooks) trained on all embeddings, for shards to copy and fill with
+    their own rows; None when the spec needs no training
+    """
+    vectors = normalize(embeddings)
+    index = new_index(spec, vectors.shape[1], len(vectors))
+    if index.is_trained:
+        return None
+    
+    index.train(vectors)
+    return index
+
+def build_index(embeddings: np.ndarray, spec: str = DEFAULT_INDEX_SPEC,
+                trained: Optional[faiss.Index] = None) -> faiss.Index:
+    """
+    Build an inner-product index of the given spec over normalized embeddings,
+    adding them to a copy of `trained` (from train_index()) when given
+    """
+    vectors = normalize(embeddings)
+    
+    if trained is not None:
+        index = faiss.clone_index(trained)
+    else:
+        index = new_index(spec, vectors.shape[1], len(vectors))
+        if not index.is_trained:
+            index.train(vectors)
+    index.add(vectors)
+    
+    return index
+
+def build_sharded_index(embeddings: np.ndarray, ranges: Sequence[Tuple[str, int, int]],
+                        spec: str = DEFAULT_INDEX_SPEC,
+                        reuse: Optional[Dict[str, faiss.Index]] = None) -> Tuple['ShardedIndex', List[str]]:
+    """
+    One shard per (name, start, end) row range. Quantizers are trained once
+    on all embeddings, since a single guideline is usually too small to
+    train IVF/PQ on its own. Shards in `reuse` are kept as they are.
+    Returns the index and the names of the shards that were built.
+    """
+    vectors = normalize(embeddings)
+    reuse = reuse or {}
+    
+    trained = None
+    if any(name not in reuse for name, _, _ in ranges):
+        trained = train_index(vectors, spec)
+    
+    shards = []
+    built = []
+    for name, start, end in ranges:
+        index = reuse.get(name)
+        if index is None:
+            index = build_index(vectors[start:end], spec, trained)
+            built.append(name)
+        shards.append((name, start, index))
+    
+    return ShardedIndex(shards), built
+
+def set_search_params(index: faiss.Index, ef_search: Optional[int] = None, nprobe: Optional[int] = None):
+    """
+    Apply query-time knobs: efSearch for HNSW indexes, nprobe for IVF indexes
+    """
+    if isinstance(index, ShardedIndex):
+        for shard in index.shards:
+            set_search_params(shard, ef_search, nprobe)
+        return
+    
+    if ef_search and hasattr(index, 'hnsw'):
+        index.hnsw.efSearch = ef_search
+    
+    if nprobe:
+        try:
+            ivf = faiss.extract_index_ivf(index)
+        except RuntimeError:
+            return
+        ivf.nprobe = min(nprobe, ivf.nlist)
+
+def rows_selector(rows: np.ndarray) -> faiss.IDSelector:
+    """
+    ID selector restricting a search to the given rows: a range selector
+    when they are contiguous (one document), a hashed batch otherwise
+    """
+    rows = np.unique(np.asarray(rows, dtype=np.int64))
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        return faiss.IDSelectorRange(int(rows[0]), int(rows[-1]) + 1)
+    return faiss.IDSelectorBatch(rows)
+
+def search_params(index: faiss.Index, selector: faiss.IDSelector, k: int,
+                  ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> faiss.SearchParameters:
+    """
+    Per-call search parameters carrying an ID selector. They replace the
+    index's own efSearch/nprobe for the call, so the current values are passed on.
+    """
+    if hasattr(index, 'hnsw'):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=max(ef_search or index.hnsw.efSearch, k))
+    
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return faiss.SearchParameters(sel=selector)
+    return faiss.SearchParametersIVF(sel=selector, nprobe=min(nprobe or ivf.nprobe, ivf.nlist))
+
+def search_rows(index: faiss.Index, queries: np.ndarray, k: int, rows: np.ndarray,
+                ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Search only the given rows, with an ID selector instead of fetching extra
+    neighbors and dropping the rest. Graph and IVF indexes can miss members
+    of a small subset; queries that come back short are redone exactly on
+    the subset's vectors, so each result holds min(k, len(rows)) rows.
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    k = min(k, len(rows))
+    if k == 0:
+        return np.zeros((len(queries), 0), dtype=np.float32), np.zeros((len(queries), 0), dtype=np.int64)
+    
+    selector = rows_selector(rows)
+    scores, indices = index.search(queries, k, params=search_params(index, selector, k, ef_search, nprobe))
+    
+    short = np.flatnonzero((indices < 0).any(axis=1))
+    if len(short):
+        scores[short], indices[short] = exact_search(queries[short], reconstruct_rows(index, rows), k, rows)
+    
+    return scores, indices
+
+def exact_search(queries: np.ndarray, vectors: np.ndarray, k: int,
+                 rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Brute-force top-k by inner product over the given vectors, reported as
+    `rows` (positions in `vectors` by default); ties keep row order
+    """
+    similarities = queries @ vectors.T
+    best = np.argsort(-similarities, axis=1, kind='stable')[:, :k]
+    if rows is None:
+        rows = np.arange(len(vectors), dtype=np.int64)
+    return np.take_along_axis(similarities, best, axis=1), np.asarray(rows, dtype=np.int64)[best]
+
+def describe_index(index: faiss.Index) -> Dict:
+    """
+    Index type and current query-time parameters, for logs and health output
+    """
+    if isinstance(index, ShardedIndex):
+        info = describe_index(index.shards[0]) if index.shards else {}
+        shard_types = sorted({type(shard).__name__ for shard in index.shards})
+        return {**info, 'type': type(index).__name__, 'shard_type': '+'.join(shard_types) or None,
+                'shards': len(index), 'ntotal': index.ntotal}
+    
+    info = {'type': type(index).__name__, 'ntotal': index.ntotal}
+    if hasattr(index, 'hnsw'):
+        info['ef_search'] = index.hnsw.efSearch
+    try:
+        info['nprobe'] = faiss.extract_index_ivf(index).nprobe
+    except RuntimeError:
+        pass
+    return info
+
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    """
+    All stored vectors in row order (approximate for quantized indexes)
+    """
+    if not isinstance(index, ShardedIndex):
+        _make_direct_map(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+def reconstruct_rows(index: faiss.Index, rows: np.ndarray) -> np.ndarray:
+    """
+    Stored vectors of the given rows (approximate for quantized indexes)
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    if not isinstance(index, ShardedIndex):
+        _make_direct_map(index)
+    return index.reconstruct_batch(rows)
+
+def _make_direct_map(index: faiss.Index):
+    """IVF indexes need a direct map before vectors can be reconstructed by id"""
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+
+def read_index_mmap(path: str) -> faiss.Index:
+    """
+    Read an index with its storage memory-mapped, so processes opening the
+    same file share physical pages; falls back to a normal read for index
+    types FAISS cannot map
+    """
+    try:
+        return faiss.read_index(path, MMAP_READ_FLAGS)
+    except RuntimeError as e:
+        logger.warning(f"Cannot memory-map {path}, reading it into memory: {e}")
+        return faiss.read_index(path)
+
+class ShardedIndex:
+    """
+    One FAISS index per guideline, each holding a consecutive range of
+    global rows. Queries fan out to the shards on a thread pool (FAISS
+    releases the GIL while searching) and the per-shard top-k lists are
+    merged with a heap. Exposes the parts of the faiss.Index interface the
+    processor and search system use, with global row ids.
+    """
+    
+    def __init__(self, shards: List[Tuple[str, int, faiss.Index]], workers: Optional[int] = None):
+        shards = sorted(shards, key=lambda shard: shard[1])
+        self.names = [name for name, _, _ in shards]
+        self.offsets = np.array([offset for _, offset, _ in shards], dtype=np.int64)
+        self.shards = [index for _, _, index in shards]
+        self.ntotal = int(sum(index.ntotal for index in self.shards))
+        self.d = self.shards[0].d if self.shards else 0
+        self.metric_type = faiss.METRIC_INNER_PRODUCT
+        self.workers = max(1, min(workers or os.cpu_count() or 1, len(self.shards)))
+        self._executor = None
+        self._executor_pid = None
+    
+    def __len__(self) -> int:
+        return len(self.shards)
+    
+    def shard(self, name: str) -> faiss.Index:
+        return self.shards[self.names.index(name)]
+    
+    def _map(self, function, items):
+        """Run function over items, on the shared thread pool when there is more than one"""
+        if len(items) <= 1 or self.workers == 1:
+            return [function(item) for item in items]
+        # Pool threads do not survive fork, so a worker forked from a preloaded
+        # (and warmed-up) parent starts its own pool
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='faiss-shard')
+            self._executor_pid = os.getpid()
+        return list(self._executor.map(function, items))
+    
+    def search(self, queries: np.ndarray, k: int, shards: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k over all shards, or only the named ones. HNSW and IVF shards
+        can return fewer hits than they hold; those queries are redone
+        exactly on the shard's stored vectors, so each shard contributes
+        min(k, shard size) rows. Results beyond the searched rows are padded
+        with row -1 and score -inf, like FAISS pads with -1.
+        """
+        selected = [i for i, name in enumerate(self.names) if shards is None or name in shards]
+        
+        def search_shard(i):
+            index = self.shards[i]
+            shard_k = min(k, index.ntotal)
+            scores, indices = index.search(queries, shard_k)
+            
+            short = np.flatnonzero((indices < 0).any(axis=1))
+            if len(short):
+                scores[short], indices[short] = exact_search(queries[short], reconstruct_all(index), shard_k)
+            return scores, indices + self.offsets[i]
+        
+        partial = self._map(search_shard, [i for i in selected if self.shards[i].ntotal])
+        
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for q in range(len(queries)):
+            # Each shard's list is sorted best first, so a k-way heap merge yields the global top-k
+            ranked = heapq.merge(*[zip(shard_scores[q], shard_indices[q]) for shard_scores, shard_indices in partial],
+                                 key=lambda hit: -hit[0])
+            for j, (score, idx) in enumerate(hit for hit in ranked if hit[1] >= 0):
+                if j == k:
+                    break
+                scores[q, j] = score
+                indices[q, j] = idx
+        
+        return scores, indices
+    
+    def locate(self, rows: np.ndarray) -> np.ndarray:
+        """Shard position of each global row"""
+        return np.searchsorted(self.offsets, np.asarray(rows, dtype=np.int64), side='right') - 1
+    
+    def reconstruct_batch(self, rows: np.ndarray) -> np.ndarray:
+        """Stored vectors of global rows, in the given order"""
+        rows = np.asarray(rows, dtype=np.int64)
+        vectors = np.zeros((len(rows), self.d), dtype=np.float32)
+        positions = self.locate(rows)
+        for i in np.unique(positions):
+            mask = positions == i
+            _make_direct_map(self.shards[i])
+            vectors[mask] = self.shards[i].reconstruct_batch(rows[mask] - self.offsets[i])
+        return vectors
+    
+    def reconstruct_n(self, start: int, n: int) -> np.ndarray:
+        return self.reconstruct_batch(np.arange(start, start + n))
+
+def shard_file(document_name: str) -> str:
+    """Path of a document's shard relative to the processed data directory, as stored in metadata.json"""
+    return f"{SHARD_DIR}/{document_name}.index"
+
+def load_sharded_index(processed_dir: str, metadata: Dict, mmap: bool = True) -> Optional[ShardedIndex]:
+    """
+    Open the shards listed in metadata.json, or None for builds that only
+    wrote a single global index
+    """
+    shards = []
+    for document_name, meta in metadata.items():
+        if 'shard' not in meta:
+            continue
+        path = os.path.join(processed_dir, meta['shard']['file'])
+        index = read_index_mmap(path) if mmap else faiss.read_index(path)
+        shards.append((document_name, meta['shard']['row_offset'], index))
+    
+    return ShardedIndex(shards) if shards else None
+
+def nearest_neighbors(vectors: np.ndarray, n: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Exact top-n neighbors of every vector among the others, by cosine
+    similarity: (scores, rows), both len(vectors) x n, best first
+    """
+    vectors = normalize(vectors)
+    n = min(n, len(vectors) - 1)
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    
+    scores = np.zeros((len(vectors), max(n, 0)), dtype=np.float32)
+    rows = np.zeros((len(vectors), max(n, 0)), dtype=np.int32)
+    if n <= 0:
+        return scores, rows
+    
+    for start in range(0, len(vectors), NEIGHBOR_BLOCK_SIZE):
+        block_scores, block_rows = exact.search(vectors[start:start + NEIGHBOR_BLOCK_SIZE], n + 1)
+        
+        # Drop each vector itself, wherever duplicates put it; the stable sort keeps the others in order
+        others = block_rows != np.arange(start, start + len(block_rows))[:, None]
+        order = np.argsort(~others, axis=1, kind='stable')[:, :n]
+        scores[start:start + len(block_rows)] = np.take_along_axis(block_scores, order, axis=1)
+        rows[start:start + len(block_rows)] = np.take_along_axis(block_rows, order, axis=1)
+    
+    return scores, rows
+
+def save_neighbor_table(path: str, scores: np.ndarray, rows: np.ndarray):
+    """
+    Save a table from nearest_neighbors() as an .npz file, replacing `path` atomically
+    """
+    with open(path + ".tmp", 'wb') as f:
+        np.savez(f, version=NEIGHBOR_TABLE_VERSION, scores=scores, rows=rows)
+    os.replace(path + ".tmp", path)
+
+def load_neighbor_table(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Load a table written by save_neighbor_table()
+    """
+    with np.load(path) as data:
+        if int(data['version']) != NEIGHBOR_TABLE_VERSION:
+            raise ValueError(f"Unsupported neighbor table version {int(data['version'])} in {path}")
+        return data['scores'], data['rows']
+
+def is_inner_product(index: faiss.Index) -> bool:
+    """
+    True if the index scores by inner product (cosine on normalized vectors)
+    """
+    return index.metric_type == faiss.METRIC_INNER_PRODUCT
+
+def migrate_to_inner_product(index: faiss.Index) -> faiss.Index:
+    """
+    Rebuild a legacy L2 index over unnormalized vectors as a normalized
+    inner-product index with the same row order
+    """
+    logger.info(f"Migrating L2 index with {index.ntotal} vectors to normalized inner-product search")
+    return build_index(reconstruct_all(index))
+
+def relevance_from_similarity(similarity: float) -> float:
+    """
+    Map a cosine similarity onto the 0-1 relevance scale shown to users
+    """
+    return float(min(1.0, max(0.0, similarity)))
+
+def benchmark_index_specs(embeddings: np.ndarray, specs: Sequence[str] = INDEX_SPECS, k: int = 10,
+                          num_queries: int = 200, ef_search: int = DEFAULT_EF_SEARCH,
+                          nprobe: int = DEFAULT_NPROBE,
+                          ranges: Optional[Sequence[Tuple[str, int, int]]] = None) -> List[Dict]:
+    """
+    Compare index specs against exact search: recall@k, serialized size,
+    single-query latency and build time. Queries are corpus vectors with a
+    little noise added so they do not trivially match themselves. With
+    `ranges`, each spec is built sharded the way build_sharded_index()
+    serves it, and index_type reports the shard types actually built.
+    """
+    vectors = normalize(embeddings)
+    k = min(k, len(vectors))
+    
+    rng = np.random.default_rng(0)
+    sample = rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)
+    queries = normalize(vectors[sample] + rng.normal(0, 0.02, size=(len(sample), vectors.shape[1])))
+    
+    exact = faiss.IndexFlatIP(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+    
+    report = []
+    for spec in specs:
+        started = time.perf_counter()
+        if ranges:
+            index, _ = build_sharded_index(vectors, ranges, spec)
+        else:
+            index = build_index(vectors, spec)
+        build_seconds = time.perf_counter() - started
+        set_search_params(index, ef_search=ef_search, nprobe=nprobe)
+        
+        # One query at a time, as the web app searches
+        found = np.empty_like(truth)
+        started = time.perf_counter()
+        for i in range(len(queries)):
+            _, found[i:i + 1] = index.search(queries[i:i + 1], k)
+        latency_ms = (time.perf_counter() - started) * 1000 / len(queries)
+        
+        recall = np.mean([len(set(found[i]) & set(truth[i])) / k for i in range(len(queries))])
+        
+        report.append({
+            'spec': spec,
+            'index_type': describe_index(index)['shard_type'] if ranges else type(index).__name__,
+            'recall_at_k': float(recall),
+            'k': k,
+            'memory_bytes': index_bytes(index),
+            'latency_ms': latency_ms,
+            'build_seconds': build_seconds
+        })
+    
+    return report
+
+def index_bytes(index) -> int:
+    """
+    Serialized size of an index, summed over the shards of a ShardedIndex
+    """
+    if isinstance(index, ShardedIndex):
+        return sum(index_bytes(shard) for shard in index.shards)
+    return int(faiss.serialize_index(index).nbytes)
+
+def format_index_report(report: List[Dict]) -> str:
+    """
+    Render a benchmark report as a text table
+    """
+    lines = [f"{'spec':<10} {'type':<14} {'recall@k':>9} {'memory':>10} {'latency':>10} {'build':>8}"]
+    for row in report:
+        lines.append(f"{row['spec']:<10} {row['index_type']:<14} {row['recall_at_k']:>9.3f} "
+                     f"{row['memory_bytes'] / 1024 / 1024:>8.2f}MB {row['latency_ms']:>8.3f}ms "
+                     f"{row['build_seconds']:>7.2f}s")
+    return "\n".join(lines)